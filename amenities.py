@@ -0,0 +1,202 @@
+import math
+import os
+import threading
+from concurrent.futures import Future
+
+import numpy as np
+from shapely import wkt
+
+import logic
+from instrumentation import traced
+from memo import PlannerCache
+from spatial import KM_PER_DEGREE, haversine
+
+# category -> OSM key and the values of that key counted in the category
+CATEGORIES = {
+    "food": ("amenity", ("restaurant", "cafe", "fast_food", "bar", "pub")),
+    "shops": ("shop", ("supermarket", "convenience", "kiosk", "bakery")),
+    "toilets": ("amenity", ("toilets",)),
+    "money": ("amenity", ("atm", "bank", "bureau_de_change")),
+    "pharmacy": ("amenity", ("pharmacy",)),
+    "parking": ("amenity", ("parking", "bicycle_parking", "bicycle_rental")),
+    "taxi": ("amenity", ("taxi",)),
+    "lodging": ("tourism", ("hotel", "hostel", "guest_house")),
+}
+
+TILE_SIZE = float(os.environ.get("AMENITY_TILE_SIZE", "0.02"))
+
+
+def tile_of(longitude, latitude, size=TILE_SIZE):
+    return math.floor(longitude / size), math.floor(latitude / size)
+
+
+def tiles_around(longitude, latitude, radius, size=TILE_SIZE):
+    dlat = radius / KM_PER_DEGREE
+    cos_lat = max(math.cos(math.radians(latitude)), 1e-6)
+    dlon = min(radius / (KM_PER_DEGREE * cos_lat), 180)
+    x0, y0 = tile_of(longitude - dlon, latitude - dlat, size)
+    x1, y1 = tile_of(longitude + dlon, latitude + dlat, size)
+    return [(x, y) for x in range(x0, x1 + 1) for y in range(y0, y1 + 1)]
+
+
+def tile_center(tile, size=TILE_SIZE):
+    return (tile[0] + 0.5) * size, (tile[1] + 0.5) * size
+
+
+def tile_bounds(tile, size=TILE_SIZE):
+    left, bottom = tile[0] * size, tile[1] * size
+    return tuple(
+        round(value, 7) for value in (left, bottom, left + size, bottom + size)
+    )
+
+
+def amenities_query(tiles, size=TILE_SIZE):
+    # the bounding box of all tiles is checked first so that the endpoint can
+    # discard most amenities before the boxes of the single tiles are tested
+    tag_values = " ".join(
+        f'(osmkey:{key} "{value}" "{category}")'
+        for category, (key, values) in CATEGORIES.items()
+        for value in values
+    )
+    bounds = np.array([tile_bounds(tile, size) for tile in tiles])
+    min_lon, min_lat = bounds[:, :2].min(axis=0)
+    max_lon, max_lat = bounds[:, 2:].max(axis=0)
+    tile_filters = " || ".join(
+        f"(?lon >= {left} && ?lon < {right} && ?lat >= {bottom} && ?lat < {top})"
+        for left, bottom, right, top in bounds.tolist()
+    )
+    return f"""
+        SELECT ?amenity ?category ?type ?name ?geometry WHERE {{
+            VALUES (?key ?type ?category) {{ {tag_values} }}
+
+            ?amenity ?key ?type ;
+                     geo:hasCentroid/geo:asWKT ?geometry .
+            BIND (geof:longitude(?geometry) AS ?lon)
+            BIND (geof:latitude(?geometry) AS ?lat)
+            FILTER (?lon >= {min_lon} && ?lon <= {max_lon}
+                    && ?lat >= {min_lat} && ?lat <= {max_lat})
+            FILTER ({tile_filters})
+            OPTIONAL {{ ?amenity osmkey:name ?name }}
+        }}
+    """
+
+
+def fetch_tiles(tiles, size=TILE_SIZE, chunk_size=50):
+    # tiles are sorted so that each query covers neighbouring tiles and its
+    # bounding box stays small
+    fetched = {tile: [] for tile in tiles}
+    seen = set()
+    for chunk in logic.chunks(sorted(tiles), chunk_size):
+        query = amenities_query(chunk, size)
+        for row in logic.connection.query(query, kind="amenities"):
+            point = wkt.loads(row["geometry"])
+            tile = tile_of(point.x, point.y, size)
+            if tile not in fetched or (row["amenity"], row["type"]) in seen:
+                continue
+            seen.add((row["amenity"], row["type"]))
+            fetched[tile].append(
+                {
+                    "amenity": row["amenity"],
+                    "name": row.get("name"),
+                    "category": row["category"],
+                    "type": row["type"],
+                    "longitude": point.x,
+                    "latitude": point.y,
+                }
+            )
+    return fetched
+
+
+class AmenityTiles:
+    def __init__(self, size=TILE_SIZE, max_tiles=4096, ttl=24 * 3600):
+        self.size = size
+        self.cache = PlannerCache(max_tiles, ttl)
+        self.inflight = {}
+        self.lock = threading.Lock()
+
+    def get(self, tiles):
+        # missing tiles are fetched together in one query, tiles that another
+        # search is already fetching are waited for
+        found, waiting, missing = {}, {}, {}
+        with self.lock:
+            for tile in dict.fromkeys(tiles):
+                amenities = self.cache.get(tile)
+                if amenities is not None:
+                    found[tile] = amenities
+                elif tile in self.inflight:
+                    waiting[tile] = self.inflight[tile]
+                else:
+                    missing[tile] = self.inflight[tile] = Future()
+
+        try:
+            fetched = fetch_tiles(list(missing), self.size) if missing else {}
+        except BaseException as e:
+            for future in missing.values():
+                future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                for tile in missing:
+                    self.inflight.pop(tile, None)
+
+        for tile, future in missing.items():
+            self.cache.put(tile, fetched[tile])
+            future.set_result(fetched[tile])
+            found[tile] = fetched[tile]
+        for tile, future in waiting.items():
+            found[tile] = future.result()
+        return found
+
+
+amenity_tiles = AmenityTiles(
+    TILE_SIZE,
+    int(os.environ.get("AMENITY_CACHE_TILES", "4096")),
+    float(os.environ.get("AMENITY_CACHE_TTL", str(24 * 3600))),
+)
+
+
+def station_point(geometry):
+    point = wkt.loads(geometry)
+    if point.geom_type != "Point":
+        point = point.centroid
+    return point.x, point.y
+
+
+@traced
+def get_station_amenities(stations, radius=0.5, categories=None):
+    # stations maps station names to their WKT geometry; the result maps them to
+    # the amenities within radius km, nearest first
+    points = {
+        name: station_point(geometry) for name, geometry in dict(stations).items()
+    }
+    if not points:
+        return {}
+    station_tiles = {
+        name: tiles_around(*point, radius, amenity_tiles.size)
+        for name, point in points.items()
+    }
+    with logic.connection.routed(*points.values()):
+        tiles = amenity_tiles.get(
+            [tile for tiles in station_tiles.values() for tile in tiles]
+        )
+
+    amenities = {}
+    for name, (longitude, latitude) in points.items():
+        candidates = [
+            amenity
+            for tile in station_tiles[name]
+            for amenity in tiles[tile]
+            if categories is None or amenity["category"] in categories
+        ]
+        distances = haversine(
+            longitude,
+            latitude,
+            np.array([amenity["longitude"] for amenity in candidates]),
+            np.array([amenity["latitude"] for amenity in candidates]),
+        )
+        amenities[name] = [
+            dict(candidates[i], distance=round(float(distances[i]), 3))
+            for i in np.argsort(distances, kind="stable")
+            if distances[i] <= radius
+        ]
+    return amenities
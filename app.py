@@ -1,12 +1,63 @@
+import os
 import streamlit as st
 import pandas as pd
 from logic import *
+from snapshot import SnapshotPlanner
+from memo import get_route_geometries, iter_routes_with_change, memoize_points, snap
+from prefetch import Prefetch
+from filters import RouteFilter
+from amenities import CATEGORIES, get_station_amenities, station_point
+from instrumentation import record
+from geometry import (
+    feature_collection,
+    get_route_segment,
+    get_route_segments,
+    tolerance_for_zoom,
+)
+from tiles import TileServer
 import folium
+import folium.plugins
 from streamlit_folium import st_folium
 from shapely import wkt
 
 st.set_page_config(page_title="Railway journey planner 🚂", layout="wide")
 
+
+@st.cache_resource
+def load_snapshot_planner(path):
+    return SnapshotPlanner.load(path)
+
+
+# the radius slider needs a maximum above its minimum of 0.1 km
+AMENITY_RADIUS_KM = max(float(os.environ.get("AMENITY_RADIUS_KM", "0.5")), 0.2)
+# the filters work on all station pairs, only the best of them are shown
+DIRECT_ROUTES_LIMIT = int(os.environ.get("DIRECT_ROUTES_LIMIT", "200"))
+AMENITY_PREFETCH_ROUTES = int(os.environ.get("AMENITY_PREFETCH_ROUTES", "10"))
+
+planner = None
+if os.environ.get("PLANNER_SNAPSHOT"):
+    planner = load_snapshot_planner(os.environ["PLANNER_SNAPSHOT"])
+    find_common_routes = planner.find_common_routes
+    find_routes_with_change = planner.find_routes_with_change
+
+
+@st.cache_resource
+def start_tile_server(port):
+    tile_server = TileServer()
+    tile_server.serve(port)
+    return tile_server
+
+
+tile_server = None
+if os.environ.get("MAP_TILES_PORT"):
+    tile_server = start_tile_server(int(os.environ["MAP_TILES_PORT"]))
+    tiles_url = os.environ.get(
+        "MAP_TILES_URL", f"http://localhost:{os.environ['MAP_TILES_PORT']}"
+    )
+
+find_common_routes = memoize_points(find_common_routes)
+find_routes_with_change = memoize_points(find_routes_with_change)
+
 st.title("Railway journey planner 🚂")
 
 if "selected_points" not in st.session_state:
@@ -33,28 +84,43 @@ if "filtered_routes" not in st.session_state:
 if "no_results" not in st.session_state:
     st.session_state.no_results = False
 
+if "route_filter" not in st.session_state:
+    st.session_state.route_filter = None
+
+if "partial_results" not in st.session_state:
+    st.session_state.partial_results = False
+
 if "alternative_lines" not in st.session_state:
     st.session_state.alternative_lines = []
 
+if "itineraries" not in st.session_state:
+    st.session_state.itineraries = None
+
+if "query_events" not in st.session_state:
+    st.session_state.query_events = []
+
+if "prefetch" not in st.session_state:
+    st.session_state.prefetch = None
+
 if st.session_state.ready and st.session_state.routes:
+    # the candidates are indexed once per search, later reruns only update masks
+    if (
+        st.session_state.route_filter is None
+        or st.session_state.route_filter.routes is not st.session_state.routes
+    ):
+        st.session_state.route_filter = RouteFilter(st.session_state.routes)
+    route_filter = st.session_state.route_filter
+
     st.sidebar.write("### Filtering")
     st.sidebar.write("#### Maximum walking distance")
     max_walking_distance = st.sidebar.slider("Distance (km)", 0.0, 10.0, 10.0, 0.1)
 
     st.sidebar.write("#### Stations")
-    start_stations = sorted(
-        set(route["start_station"] for route in (st.session_state.routes or []))
-    )
-    end_stations = sorted(
-        set(route["end_station"] for route in (st.session_state.routes or []))
-    )
-    operators = sorted(
-        set(
-            route["operator"]
-            for route in (st.session_state.routes or [])
-            if route["operator"]
-        )
-    )
+    start_stations = route_filter.categories["start_station"]
+    end_stations = route_filter.categories["end_station"]
+    operators = [
+        operator for operator in route_filter.categories["operator"] if operator
+    ]
 
     start_station_filter = st.sidebar.selectbox(
         "Start station", ["All"] + start_stations
@@ -63,12 +129,25 @@ if st.session_state.ready and st.session_state.routes:
 
     st.sidebar.write("#### Operators")
     selected_operators = []
+    operator_columns = {}
     for operator in operators:
-        if operator:
-            if st.sidebar.checkbox(operator, value=True):
-                selected_operators.append(operator)
-
-    other = st.sidebar.checkbox("Other (no operator)", value=True)
+        checkbox_column, operator_columns[operator] = st.sidebar.columns([3, 1])
+        if checkbox_column.checkbox(operator, value=True):
+            selected_operators.append(operator)
+
+    checkbox_column, operator_columns[""] = st.sidebar.columns([3, 1])
+    other = checkbox_column.checkbox("Other (no operator)", value=True)
+
+    route_filter.update(
+        max_walking_distance,
+        None if start_station_filter == "All" else start_station_filter,
+        None if end_station_filter == "All" else end_station_filter,
+        selected_operators,
+        other,
+    )
+    operator_counts = route_filter.facet_counts("operator")
+    for operator, column in operator_columns.items():
+        column.caption(f"{operator_counts.get(operator, 0)} routes")
 
     st.sidebar.write("#### Other")
     unique_routes_only = st.sidebar.checkbox(
@@ -79,31 +158,9 @@ if st.session_state.ready and st.session_state.routes:
     )
 
     if st.sidebar.button("Filter"):
-        if st.session_state.routes is not None:
-            filtered_routes = [
-                route
-                for route in st.session_state.routes
-                if (
-                    route["total_distance"] <= max_walking_distance
-                    and (
-                        start_station_filter == "All"
-                        or start_station_filter == route["start_station"]
-                    )
-                    and (
-                        end_station_filter == "All"
-                        or end_station_filter == route["end_station"]
-                    )
-                    and (
-                        route.get("operator") in selected_operators
-                        or (other and not route.get("operator"))
-                    )
-                )
-            ]
-
-        if unique_routes_only:
-            filtered_routes = get_unique_routes(filtered_routes)
-        if unique_route_names_only:
-            filtered_routes = get_unique_routes_by_name(filtered_routes)
+        filtered_routes = route_filter.apply(
+            unique_routes_only, unique_route_names_only
+        )
 
         if not filtered_routes:
             st.session_state.no_results = True
@@ -120,11 +177,32 @@ if st.session_state.ready and st.session_state.routes:
 def handle_map_click(lat_, lon_):
     if len(st.session_state.selected_points) < 2:
         st.session_state.selected_points.append({"lat": lat_, "lon": lon_})
+        # look up the first point while the user picks the second one, using the
+        # coordinates the memoized search will snap it to; the snapshot planner
+        # and a disabled query cache leave nothing for the search to reuse
+        if (
+            len(st.session_state.selected_points) == 1
+            and planner is None
+            and query_cache is not None
+        ):
+            st.session_state.prefetch = Prefetch(
+                snap(lon_)[1], snap(lat_)[1], find_routes_near_point
+            )
         st.rerun()
     else:
         st.warning("You can only select two points. Clear the points to reset.")
 
 
+max_changes = 1
+if planner is not None:
+    st.sidebar.write("### Changes")
+    max_changes = st.sidebar.number_input(
+        "Maximum number of changes", min_value=1, max_value=3, value=1
+    )
+
+st.sidebar.write("### Search")
+search_timeout = st.sidebar.slider("Time limit (s)", 5, 120, 30)
+
 st.sidebar.write("### Add points manually")
 lat = st.sidebar.number_input("Latitude", value=0.0, format="%.6f")
 lon = st.sidebar.number_input("Longitude", value=0.0, format="%.6f")
@@ -147,6 +225,44 @@ if st.sidebar.button("Clear selected points"):
     st.session_state.no_results = False
     st.session_state.filtered_routes = None
     st.session_state.alternative_lines = []
+    st.session_state.itineraries = None
+    st.session_state.partial_results = False
+    if st.session_state.prefetch is not None:
+        st.session_state.prefetch.cancel()
+        st.session_state.prefetch = None
+
+
+def add_route_layer(m, name, segments, tooltip=False):
+    if not segments:
+        return
+    if tile_server is not None:
+        layer_id = tile_server.register(segments)
+        colors = {properties["color"] for _, properties in segments}
+        folium.plugins.VectorGridProtobuf(
+            f"{tiles_url}/{layer_id}/{{z}}/{{x}}/{{y}}.pbf",
+            name,
+            {
+                "vectorTileLayerStyles": {
+                    color: {"color": color, "weight": 3} for color in colors
+                }
+            },
+        ).add_to(m)
+        return
+
+    folium.GeoJson(
+        feature_collection(segments),
+        name=name,
+        style_function=lambda feature: {
+            "color": feature["properties"]["color"],
+            "weight": 3,
+        },
+        tooltip=(
+            folium.GeoJsonTooltip(fields=["route"], aliases=["Route:"])
+            if tooltip
+            else None
+        ),
+    ).add_to(m)
+
 
 m = folium.Map(location=[52.228, 21.0], zoom_start=10)
 
@@ -164,20 +280,28 @@ for point in st.session_state.endpoints:
         fill_opacity=0.7,
     ).add_to(m)
 
-for line_coords in st.session_state.alternative_lines:
-    folium.PolyLine(line_coords, color="blue", weight=3).add_to(m)
-
-for line_coords in st.session_state.lines:
-    folium.PolyLine(line_coords, color="red", weight=3).add_to(m)
+add_route_layer(
+    m,
+    "Alternatives",
+    [(segment, {"color": "blue"}) for segment in st.session_state.alternative_lines],
+)
+add_route_layer(
+    m, "Route", [(segment, {"color": "red"}) for segment in st.session_state.lines]
+)
 
 if "route_lines" in st.session_state:
     colors = ["blue", "green", "orange"]
-    for idx, (route_name, lines) in enumerate(st.session_state.route_lines.items()):
-        color = colors[idx % len(colors)]
-        for line in lines:
-            folium.PolyLine(
-                line, color=color, weight=3, tooltip=f"Route: {route_name}"
-            ).add_to(m)
+    add_route_layer(
+        m,
+        "All routes",
+        [
+            (segment, {"color": colors[idx % len(colors)], "route": route_name})
+            for idx, (route_name, segment) in enumerate(
+                st.session_state.route_lines.items()
+            )
+        ],
+        tooltip=True,
+    )
 
 if len(st.session_state.selected_points) < 2:
     m.add_child(folium.ClickForMarker(popup=None))
@@ -189,7 +313,15 @@ if map_data and map_data.get("last_clicked") is not None:
     if {"lat": lat, "lon": lon} not in st.session_state.selected_points:
         handle_map_click(lat, lon)
 
+zoom = (map_data or {}).get("zoom") or 10
+tolerance = tolerance_for_zoom(zoom)
+
 if len(st.session_state.selected_points) == 2 and not st.session_state.ready:
+    if st.session_state.prefetch is not None:
+        st.session_state.prefetch.wait()
+        st.session_state.prefetch = None
+
+    st.session_state.query_events = []
     lat1, lon1 = (
         st.session_state.selected_points[0]["lat"],
         st.session_state.selected_points[0]["lon"],
@@ -199,113 +331,212 @@ if len(st.session_state.selected_points) == 2 and not st.session_state.ready:
         st.session_state.selected_points[1]["lon"],
     )
 
-    try:
-        common_routes = find_common_routes(lat1, lon1, lat2, lon2)
-        st.session_state.ready = True
-
-        if common_routes:
-            closest_route = common_routes[0]
-            geometry_wkt = get_route_geometry(closest_route["route"])
-            geometry = wkt.loads(geometry_wkt)
-
-            if geometry.geom_type == "GeometryCollection":
-                for geom in geometry.geoms:
-                    if geom.geom_type == "LineString":
-                        coordinates = [(point[1], point[0]) for point in geom.coords]
-                        st.session_state.lines.append(coordinates)
-
-            start_station_geometry = wkt.loads(closest_route["start_station_geometry"])
-            end_station_geometry = wkt.loads(closest_route["end_station_geometry"])
-
-            if start_station_geometry.geom_type == "Point":
-                st.session_state.endpoints.append(
-                    (
-                        start_station_geometry.y,
-                        start_station_geometry.x,
-                        closest_route["start_station"],
+    # route geometries of a search are fetched from the same regional endpoint
+    with record(st.session_state.query_events), connection.routed(
+        (lon1, lat1), (lon2, lat2)
+    ):
+        try:
+            common_routes = find_common_routes(lat1, lon1, lat2, lon2)
+            st.session_state.ready = True
+
+            if common_routes:
+                closest_route = common_routes[0]
+                st.session_state.lines.append(
+                    get_route_segment(
+                        closest_route["route"],
+                        closest_route["start_station_geometry"],
+                        closest_route["end_station_geometry"],
+                        tolerance,
                     )
                 )
 
-            if end_station_geometry.geom_type == "Point":
-                st.session_state.endpoints.append(
-                    (
-                        end_station_geometry.y,
-                        end_station_geometry.x,
-                        closest_route["end_station"],
+                start_station_geometry = wkt.loads(
+                    closest_route["start_station_geometry"]
+                )
+                end_station_geometry = wkt.loads(closest_route["end_station_geometry"])
+
+                if start_station_geometry.geom_type == "Point":
+                    st.session_state.endpoints.append(
+                        (
+                            start_station_geometry.y,
+                            start_station_geometry.x,
+                            closest_route["start_station"],
+                        )
+                    )
+
+                if end_station_geometry.geom_type == "Point":
+                    st.session_state.endpoints.append(
+                        (
+                            end_station_geometry.y,
+                            end_station_geometry.x,
+                            closest_route["end_station"],
+                        )
+                    )
+
+                st.session_state.routes = common_routes
+                # amenities of all stations in the results are fetched in the
+                # background, so the station details open without waiting
+                submit(
+                    get_station_amenities,
+                    {
+                        name: geometry
+                        for route in common_routes[:AMENITY_PREFETCH_ROUTES]
+                        for name, geometry in (
+                            (route["start_station"], route["start_station_geometry"]),
+                            (route["end_station"], route["end_station_geometry"]),
+                        )
+                    },
+                    AMENITY_RADIUS_KM,
+                )
+                st.rerun()
+            elif max_changes > 1:
+                itineraries = memoize_points(planner.find_routes_with_changes)(
+                    lat1, lon1, lat2, lon2, max_changes
+                )
+                if itineraries:
+                    st.session_state.itineraries = itineraries
+                    itinerary = itineraries[0]
+
+                    station_geometries = (
+                        [itinerary["start_station_geometry"]]
+                        + itinerary["change_geometries"]
+                        + [itinerary["end_station_geometry"]]
+                    )
+                    legs = [
+                        (route, station_geometries[i], station_geometries[i + 1])
+                        for i, route in enumerate(itinerary["routes"])
+                    ]
+                    segments = get_route_segments(legs, tolerance)
+                    for leg in legs:
+                        st.session_state.lines.append(segments[leg])
+
+                    station_names = (
+                        [itinerary["start_station"]]
+                        + ["Change here"] * len(itinerary["change_geometries"])
+                        + [itinerary["end_station"]]
+                    )
+                    for station_geometry, station_name in zip(
+                        station_geometries, station_names
+                    ):
+                        station_geometry = wkt.loads(station_geometry)
+                        if station_geometry.geom_type == "Point":
+                            st.session_state.endpoints.append(
+                                (station_geometry.y, station_geometry.x, station_name)
+                            )
+                st.rerun()
+            else:
+                # routes with a change are shown as soon as each one is confirmed;
+                # the search stops with what it has found when the time limit is hit
+                token = Cancellation(search_timeout)
+                if planner is not None:
+                    stream = iter(find_routes_with_change(lat1, lon1, lat2, lon2))
+                else:
+                    stream = iter_routes_with_change(
+                        lat1, lon1, lat2, lon2, token=token
+                    )
+                progress = st.empty()
+                possible_routes = []
+                for possible_route in stream:
+                    possible_routes.append(possible_route)
+                    progress.dataframe(
+                        pd.DataFrame(possible_routes)[
+                            ["route_name_a", "change_name", "route_name_b"]
+                        ].rename(
+                            columns={
+                                "route_name_a": "First route name",
+                                "change_name": "Change station",
+                                "route_name_b": "Second route name",
+                            }
+                        )
+                    )
+                progress.empty()
+                if planner is None:
+                    st.session_state.partial_results = token.cancelled
+                # the stream yields routes in the order their queries finish, they
+                # are ranked like the planner ranks them and the first one is drawn
+                # as the recommended route
+                possible_routes.sort(
+                    key=lambda possible_route: float(
+                        ranking_score(
+                            possible_route["distance_a"] + possible_route["distance_b"],
+                            possible_route["ride_distance"],
+                        )
                     )
                 )
 
-            st.session_state.routes = common_routes
-            st.rerun()
-        else:
-            possible_routes = find_routes_with_change(lat1, lon1, lat2, lon2)
-            if possible_routes:
-                st.session_state.route_with_change = possible_routes
-
-                for i, possible_route in enumerate(possible_routes):
-                    route_a = possible_route["route_a"]
-                    route_b = possible_route["route_b"]
-                    change_station = possible_route["change"]
-                    station_a_name = possible_route["station_name_a"]
-                    station_b_name = possible_route["station_name_b"]
-                    station_a_geometry = possible_route["station_geometry_a"]
-                    station_b_geometry = possible_route["station_geometry_b"]
-
-                    geometry_route_a = get_route_geometry(route_a)
-                    geometry_route_b = get_route_geometry(route_b)
-
-                    for geometry_wkt in [geometry_route_a, geometry_route_b]:
-                        geometry = wkt.loads(geometry_wkt)
-                        if geometry.geom_type == "GeometryCollection":
-                            for geom in geometry.geoms:
-                                if geom.geom_type == "LineString":
-                                    coordinates = [
-                                        (point[1], point[0]) for point in geom.coords
-                                    ]
-                                    if i == 0:
-                                        st.session_state.lines.append(coordinates)
-                                    else:
-                                        st.session_state.alternative_lines.append(
-                                            coordinates
-                                        )
-
-                    change_station_geometry = get_route_geometry(change_station)
-                    change_station_geometry = wkt.loads(change_station_geometry)
-
-                    if change_station_geometry.geom_type == "Point":
-                        st.session_state.endpoints.append(
+                if possible_routes:
+                    st.session_state.route_with_change = possible_routes
+                    change_geometries = get_route_geometries(
+                        possible_route["change"] for possible_route in possible_routes
+                    )
+                    legs = [
+                        leg
+                        for possible_route in possible_routes
+                        for leg in (
                             (
-                                change_station_geometry.y,
-                                change_station_geometry.x,
-                                "Change here",
-                            )
+                                possible_route["route_a"],
+                                possible_route["station_geometry_a"],
+                                change_geometries[possible_route["change"]],
+                            ),
+                            (
+                                possible_route["route_b"],
+                                change_geometries[possible_route["change"]],
+                                possible_route["station_geometry_b"],
+                            ),
                         )
+                    ]
+                    segments = get_route_segments(legs, tolerance)
 
-                    if i == 0:
-                        start_station_geometry = wkt.loads(station_a_geometry)
-                        end_station_geometry = wkt.loads(station_b_geometry)
+                    for i, possible_route in enumerate(possible_routes):
+                        change_station = possible_route["change"]
+                        station_a_name = possible_route["station_name_a"]
+                        station_b_name = possible_route["station_name_b"]
+                        station_a_geometry = possible_route["station_geometry_a"]
+                        station_b_geometry = possible_route["station_geometry_b"]
 
-                        if start_station_geometry.geom_type == "Point":
+                        for leg in legs[2 * i : 2 * i + 2]:
+                            if i == 0:
+                                st.session_state.lines.append(segments[leg])
+                            else:
+                                st.session_state.alternative_lines.append(segments[leg])
+
+                        change_station_geometry = change_geometries[change_station]
+                        change_station_geometry = wkt.loads(change_station_geometry)
+
+                        if change_station_geometry.geom_type == "Point":
                             st.session_state.endpoints.append(
                                 (
-                                    start_station_geometry.y,
-                                    start_station_geometry.x,
-                                    station_a_name,
+                                    change_station_geometry.y,
+                                    change_station_geometry.x,
+                                    "Change here",
                                 )
                             )
 
-                        if end_station_geometry.geom_type == "Point":
-                            st.session_state.endpoints.append(
-                                (
-                                    end_station_geometry.y,
-                                    end_station_geometry.x,
-                                    station_b_name,
+                        if i == 0:
+                            start_station_geometry = wkt.loads(station_a_geometry)
+                            end_station_geometry = wkt.loads(station_b_geometry)
+
+                            if start_station_geometry.geom_type == "Point":
+                                st.session_state.endpoints.append(
+                                    (
+                                        start_station_geometry.y,
+                                        start_station_geometry.x,
+                                        station_a_name,
+                                    )
                                 )
-                            )
-            st.rerun()
 
-    except Exception as e:
-        st.error(f"An error occurred: {e}")
+                            if end_station_geometry.geom_type == "Point":
+                                st.session_state.endpoints.append(
+                                    (
+                                        end_station_geometry.y,
+                                        end_station_geometry.x,
+                                        station_b_name,
+                                    )
+                                )
+                st.rerun()
+
+        except Exception as e:
+            st.error(f"An error occurred: {e}")
 
 if st.session_state.ready:
     if st.session_state.routes is not None:
@@ -316,14 +547,23 @@ if st.session_state.ready:
         st.write(f"From: {closest_route['start_station']}")
         st.write(f"To: {closest_route['end_station']}")
         st.write(f"Total distance to stations: {closest_route['total_distance']} km")
+        if closest_route.get("ride_distance") is not None:
+            st.write(f"Distance along the route: {closest_route['ride_distance']} km")
 
         if st.checkbox("Display station details", value=False):
-            st.session_state.routes[0]["details_start"] = get_station_details(
+            with connection.routed(
+                station_point(closest_route["start_station_geometry"]),
+                station_point(closest_route["end_station_geometry"]),
+            ):
+                details = get_stations_details(
+                    [closest_route["start_station"], closest_route["end_station"]]
+                )
+            st.session_state.routes[0]["details_start"] = details[
                 closest_route["start_station"]
-            )
-            st.session_state.routes[0]["details_end"] = get_station_details(
+            ]
+            st.session_state.routes[0]["details_end"] = details[
                 closest_route["end_station"]
-            )
+            ]
 
             st.write("#### Stations details")
             st.write("##### Start station details")
@@ -339,6 +579,52 @@ if st.session_state.ready:
                 else "No details found"
             )
 
+            st.write("#### Amenities around the stations")
+            amenity_column, radius_column = st.columns([3, 1])
+            categories = amenity_column.multiselect(
+                "Categories", list(CATEGORIES), default=list(CATEGORIES)
+            )
+            radius = radius_column.slider(
+                "Radius (km)", 0.1, AMENITY_RADIUS_KM, AMENITY_RADIUS_KM, 0.1
+            )
+            try:
+                amenities = get_station_amenities(
+                    {
+                        closest_route["start_station"]: closest_route[
+                            "start_station_geometry"
+                        ],
+                        closest_route["end_station"]: closest_route[
+                            "end_station_geometry"
+                        ],
+                    },
+                    radius,
+                    categories,
+                )
+            except Exception as e:
+                amenities = None
+                st.warning(f"Could not load amenities: {e}")
+            if amenities is not None:
+                for station in (
+                    closest_route["start_station"],
+                    closest_route["end_station"],
+                ):
+                    st.write(f"##### {station}")
+                    if amenities[station]:
+                        st.write(
+                            pd.DataFrame(amenities[station])[
+                                ["name", "category", "type", "distance"]
+                            ].rename(
+                                columns={
+                                    "name": "Name",
+                                    "category": "Category",
+                                    "type": "Type",
+                                    "distance": "Distance (km)",
+                                }
+                            )
+                        )
+                    else:
+                        st.write("No amenities found")
+
         st.write("### All direct train routes found")
         if not st.session_state.filtered_routes and st.session_state.no_results:
             st.write("No results matching the filter criteria were found.")
@@ -349,51 +635,77 @@ if st.session_state.ready:
                 "end_station": "End station",
                 "operator": "Operator",
                 "total_distance": "Walking distance (km)",
+                "ride_distance": "Ride distance (km)",
             }
 
             routes_to_display = (
                 st.session_state.filtered_routes or st.session_state.routes
-            )
+            )[:DIRECT_ROUTES_LIMIT]
+            columns = [
+                "route_name",
+                "start_station",
+                "end_station",
+                "operator",
+                "total_distance",
+            ]
+            if station_offsets is not None:
+                columns.append("ride_distance")
             st.write(
-                pd.DataFrame(routes_to_display)[
-                    [
-                        "route_name",
-                        "start_station",
-                        "end_station",
-                        "operator",
-                        "total_distance",
-                    ]
-                ].rename(columns=column_mapping)
+                pd.DataFrame(routes_to_display)
+                .reindex(columns=columns)
+                .rename(columns=column_mapping)
             )
 
             if 0 < len(routes_to_display) <= 3:
                 if st.button("Show all routes on the map"):
                     route_lines = {}
+                    segments = get_route_segments(
+                        (
+                            (
+                                route["route"],
+                                route["start_station_geometry"],
+                                route["end_station_geometry"],
+                            )
+                            for route in routes_to_display
+                        ),
+                        tolerance,
+                    )
                     for route in routes_to_display:
-                        geometry_wkt = get_route_geometry(route["route"])
-                        geometry = wkt.loads(geometry_wkt)
-
-                        lines = []
-                        if geometry.geom_type == "GeometryCollection":
-                            for geom in geometry.geoms:
-                                if geom.geom_type == "LineString":
-                                    coordinates = [
-                                        (point[1], point[0]) for point in geom.coords
-                                    ]
-                                    lines.append(coordinates)
-                        elif geometry.geom_type == "LineString":
-                            coordinates = [
-                                (point[1], point[0]) for point in geometry.coords
-                            ]
-                            lines.append(coordinates)
-
-                        route_lines[route["route_name"]] = lines
+                        route_lines[route["route_name"]] = segments[
+                            (
+                                route["route"],
+                                route["start_station_geometry"],
+                                route["end_station_geometry"],
+                            )
+                        ]
 
                     st.session_state.route_lines = route_lines
                     st.rerun()
 
+    elif st.session_state.itineraries:
+        st.write("### Possible routes with changes")
+
+        st.write(
+            pd.DataFrame(
+                [
+                    {
+                        "Routes": " → ".join(itinerary["route_names"]),
+                        "Start station": itinerary["start_station"],
+                        "Change stations": ", ".join(itinerary["change_names"]),
+                        "End station": itinerary["end_station"],
+                        "Changes": itinerary["transfers"],
+                        "Walking distance (km)": itinerary["total_distance"],
+                    }
+                    for itinerary in st.session_state.itineraries
+                ]
+            )
+        )
     elif st.session_state.route_with_change:
         st.write("### Possible routes with changes")
+        if st.session_state.partial_results:
+            st.warning(
+                "The search reached its time limit, more routes may be available."
+            )
 
         routes_with_change_df = pd.DataFrame(st.session_state.route_with_change).rename(
             columns={
@@ -407,6 +719,7 @@ if st.session_state.ready:
                 "station_name_b": "End station",
                 "station_geometry_a": "Start station geometry",
                 "station_geometry_b": "End station geometry",
+                "ride_distance": "Ride distance (km)",
             }
         )
 
@@ -419,7 +732,61 @@ if st.session_state.ready:
                     "End station",
                     "Change station",
                 ]
+                + (["Ride distance (km)"] if station_offsets is not None else [])
             ]
         )
+    elif st.session_state.partial_results:
+        st.write("No routes found before the search reached its time limit.")
     else:
         st.write("No routes found between the selected points.")
+
+if st.sidebar.checkbox("Show query waterfall", value=False):
+    st.write("### Queries behind the last search")
+    if st.session_state.query_events:
+        events = pd.DataFrame(st.session_state.query_events)
+        events["end"] = events["start"] + events["duration"]
+        origin = events["start"].min()
+        events["start_ms"] = (events["start"] - origin) * 1000
+        events["end_ms"] = (events["end"] - origin) * 1000
+        events["duration_ms"] = events["duration"] * 1000
+        events["label"] = events["type"] + ": " + events["name"]
+        events = events.sort_values("start_ms")
+
+        st.vega_lite_chart(
+            events,
+            {
+                "mark": "bar",
+                "encoding": {
+                    "y": {"field": "label", "type": "nominal", "sort": None},
+                    "x": {"field": "start_ms", "type": "quantitative"},
+                    "x2": {"field": "end_ms"},
+                    "color": {"field": "type", "type": "nominal"},
+                    "tooltip": [
+                        {"field": column}
+                        for column in ("label", "duration_ms", "rows", "bytes", "cache")
+                        if column in events
+                    ],
+                },
+            },
+            use_container_width=True,
+        )
+        st.write(
+            events[
+                [
+                    column
+                    for column in (
+                        "label",
+                        "parent",
+                        "start_ms",
+                        "duration_ms",
+                        "rows",
+                        "bytes",
+                        "cache",
+                        "error",
+                    )
+                    if column in events
+                ]
+            ]
+        )
+    else:
+        st.write("No queries recorded yet.")
@@ -0,0 +1,287 @@
+import argparse
+import glob
+import os
+import re
+import sys
+import threading
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import pandas as pd
+
+import logic
+from memo import PlannerCache
+from transport import RateLimiter
+
+POINT_COLUMNS = ["lat1", "lon1", "lat2", "lon2"]
+
+RESULT_COLUMNS = [
+    "id",
+    *POINT_COLUMNS,
+    "result",
+    "rank",
+    "route_a",
+    "route_name_a",
+    "route_b",
+    "route_name_b",
+    "start_station",
+    "change_station",
+    "end_station",
+    "operator_a",
+    "operator_b",
+    "total_distance",
+]
+
+
+def read_table(path, columns=None):
+    if path.endswith(".parquet"):
+        return pd.read_parquet(path, columns=columns)
+    return pd.read_csv(path, usecols=columns, dtype={"id": str})
+
+
+def read_pairs(path, id_column="id"):
+    pairs = read_table(path)
+    missing = [column for column in POINT_COLUMNS if column not in pairs.columns]
+    if missing:
+        raise ValueError(f"{path} has no {', '.join(missing)} column")
+    if id_column in pairs.columns:
+        pairs = pairs.rename(columns={id_column: "id"})
+    else:
+        pairs["id"] = pairs.index
+    pairs["id"] = pairs["id"].astype(str)
+    if pairs["id"].duplicated().any():
+        raise ValueError(f"{path} has duplicated values in the {id_column} column")
+    return pairs[["id", *POINT_COLUMNS]]
+
+
+def part_paths(directory):
+    return [
+        path
+        for path in glob.glob(os.path.join(directory, "part-*"))
+        if not path.endswith(".tmp")
+    ]
+
+
+def finished_ids(directory):
+    ids = set()
+    for path in part_paths(directory):
+        ids.update(read_table(path, ["id"])["id"].astype(str))
+    return ids
+
+
+class PartWriter:
+    def __init__(self, directory, file_format="parquet", rows_per_part=1000):
+        self.directory = directory
+        self.file_format = file_format
+        self.rows_per_part = rows_per_part
+        self.rows = []
+        os.makedirs(directory, exist_ok=True)
+        # parts of earlier runs may have been removed, so numbering continues
+        # after the highest part rather than after the number of parts
+        self.part = 0
+        for path in part_paths(directory):
+            match = re.match(r"part-(\d+)\.", os.path.basename(path))
+            if match:
+                self.part = max(self.part, int(match.group(1)) + 1)
+
+    def write(self, rows):
+        self.rows.extend(rows)
+        if len(self.rows) >= self.rows_per_part:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        frame = pd.DataFrame(self.rows, columns=RESULT_COLUMNS)
+        path = os.path.join(self.directory, f"part-{self.part:05d}.{self.file_format}")
+        temporary = path + ".tmp"
+        if self.file_format == "parquet":
+            frame.to_parquet(temporary, index=False)
+        else:
+            frame.to_csv(temporary, index=False)
+        # a part is either complete or absent, so an interrupted run can resume
+        os.replace(temporary, path)
+        self.part += 1
+        self.rows = []
+
+
+def plan_pair(pair, near_point, radius=None, limit=15, best_per=None):
+    routes_place_a = near_point(pair["lon1"], pair["lat1"], radius)
+    routes_place_b = near_point(pair["lon2"], pair["lat2"], radius)
+    base = {"id": pair["id"], **{column: pair[column] for column in POINT_COLUMNS}}
+
+    common_routes = logic.match_common_routes(
+        routes_place_a, routes_place_b, limit, best_per
+    )
+    if common_routes:
+        return [
+            {
+                **base,
+                "result": "direct",
+                "rank": rank,
+                "route_a": route["route"],
+                "route_name_a": route["route_name"],
+                "start_station": route["start_station"],
+                "end_station": route["end_station"],
+                "operator_a": route["operator"],
+                "total_distance": route["total_distance"],
+            }
+            for rank, route in enumerate(common_routes)
+        ]
+
+    with logic.connection.routed(
+        (pair["lon1"], pair["lat1"]), (pair["lon2"], pair["lat2"])
+    ):
+        transfers = logic.get_transfers(
+            logic.unique_route_ids(routes_place_a),
+            logic.unique_route_ids(routes_place_b),
+        )
+    routes_with_change = logic.match_routes_with_change(
+        routes_place_a, routes_place_b, transfers, limit
+    )
+    if routes_with_change:
+        return [
+            {
+                **base,
+                "result": "change",
+                "rank": rank,
+                "route_a": route["route_a"],
+                "route_name_a": route["route_name_a"],
+                "route_b": route["route_b"],
+                "route_name_b": route["route_name_b"],
+                "start_station": route["station_name_a"],
+                "change_station": route["change_name"],
+                "end_station": route["station_name_b"],
+                "operator_a": route["operator_a"],
+                "operator_b": route["operator_b"],
+                "total_distance": round(route["distance_a"] + route["distance_b"], 2),
+            }
+            for rank, route in enumerate(routes_with_change)
+        ]
+
+    return [{**base, "result": "none"}]
+
+
+def pair_points(pair):
+    return (pair["lon1"], pair["lat1"]), (pair["lon2"], pair["lat2"])
+
+
+def run_batch(
+    pairs, writer, workers=8, radius=None, limit=15, best_per=None, progress=None
+):
+    # every point is looked up once, however many pairs share it, and its rows
+    # are dropped once the last pair that uses it is planned
+    records = pairs.sort_values(["lat1", "lon1"]).to_dict("records")
+    uses = Counter(point for pair in records for point in pair_points(pair))
+    uses_lock = threading.Lock()
+    point_cache = PlannerCache(max_entries=len(uses), ttl=float("inf"))
+
+    def near_point(longitude, latitude, radius):
+        return point_cache.get_or_compute(
+            (longitude, latitude, radius),
+            lambda: logic.find_routes_near_point(longitude, latitude, radius),
+        )
+
+    def release(point):
+        with uses_lock:
+            uses[point] -= 1
+            if uses[point]:
+                return
+            del uses[point]
+        point_cache.discard((*point, radius))
+
+    def plan(pair):
+        try:
+            return plan_pair(pair, near_point, radius, limit, best_per)
+        finally:
+            for point in pair_points(pair):
+                release(point)
+
+    done, failed = 0, []
+    pending = {}
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for pair in records:
+                while len(pending) >= 2 * workers:
+                    done, failed = collect(pending, writer, done, failed, progress)
+                future = executor.submit(plan, pair)
+                pending[future] = pair["id"]
+            while pending:
+                done, failed = collect(pending, writer, done, failed, progress)
+    finally:
+        writer.flush()
+    return done, failed
+
+
+def collect(pending, writer, done, failed, progress=None):
+    finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+    for future in finished:
+        pair_id = pending.pop(future)
+        try:
+            writer.write(future.result())
+            done += 1
+        except Exception as e:
+            failed.append((pair_id, e))
+        if progress is not None:
+            progress(done, failed)
+    return done, failed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Plan journeys for many origin-destination pairs"
+    )
+    parser.add_argument(
+        "pairs", help="CSV or Parquet file with lat1, lon1, lat2 and lon2 columns"
+    )
+    parser.add_argument("output", help="directory to write the results to")
+    parser.add_argument("--id-column", default="id")
+    parser.add_argument("--format", choices=["parquet", "csv"], default="parquet")
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument(
+        "--rate", type=float, help="maximum number of SPARQL queries per second"
+    )
+    parser.add_argument(
+        "--radius",
+        type=float,
+        help="kilometres, by default 5 or up to the largest adaptive radius",
+    )
+    parser.add_argument("--limit", type=int, default=15)
+    parser.add_argument("--best-per", choices=["route", "route_name", "stations"])
+    parser.add_argument("--rows-per-part", type=int, default=1000)
+    args = parser.parse_args()
+
+    if args.format == "parquet" or args.pairs.endswith(".parquet"):
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            parser.error("reading and writing Parquet requires pyarrow")
+
+    if args.rate:
+        limiter = RateLimiter(args.rate)
+        for endpoint in logic.connection.endpoints:
+            endpoint.transport.rate_limiter = limiter
+        logic.wikidata_connection.transport.rate_limiter = limiter
+
+    pairs = read_pairs(args.pairs, args.id_column)
+    skipped = finished_ids(args.output)
+    pairs = pairs[~pairs["id"].isin(skipped)]
+    print(f"{len(pairs)} pairs to plan, {len(skipped)} already done")
+
+    def progress(done, failed):
+        if (done + len(failed)) % 100 == 0:
+            print(f"{done} planned, {len(failed)} failed", file=sys.stderr)
+
+    writer = PartWriter(args.output, args.format, args.rows_per_part)
+    done, failed = run_batch(
+        pairs, writer, args.workers, args.radius, args.limit, args.best_per, progress
+    )
+    for pair_id, error in failed:
+        print(f"{pair_id}: {type(error).__name__}: {error}", file=sys.stderr)
+    print(f"{done} planned, {len(failed)} failed")
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
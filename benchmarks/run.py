@@ -0,0 +1,243 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import requests
+
+import logic
+
+SCENARIOS = {
+    "dense_urban": {
+        "description": "Warsaw city centre to Pruszków",
+        "points": (52.2297, 21.0122, 52.1709, 20.8119),
+    },
+    "cross_border": {
+        "description": "Berlin Hauptbahnhof to Poznań",
+        "points": (52.5251, 13.3694, 52.4064, 16.9252),
+    },
+    "no_direct_route": {
+        "description": "Zakopane to Hel",
+        "points": (49.2992, 19.9496, 54.6081, 18.8009),
+    },
+}
+
+METRICS = ("wall_time", "queries", "bytes", "peak_memory")
+
+
+def start_stub(port, fixtures, latency, jitter, record):
+    command = [
+        sys.executable,
+        "-m",
+        "benchmarks.stub_endpoint",
+        "--port",
+        str(port),
+        "--fixtures",
+        fixtures,
+        "--latency",
+        str(latency),
+        "--jitter",
+        str(jitter),
+    ]
+    if record:
+        command.append("--record")
+    process = subprocess.Popen(command)
+
+    url = f"http://127.0.0.1:{port}"
+    for _ in range(100):
+        try:
+            requests.get(f"{url}/__stats", timeout=1)
+            return process, url
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError("stub endpoint did not start")
+
+
+def use_stub(url):
+    logic.connection = logic.SparqlConnection(endpoint=f"{url}/osm")
+    logic.wikidata_connection = logic.WikidataConnection(endpoint=f"{url}/wikidata")
+
+
+def measure(url, repeat, function, *args):
+    runs = []
+    result = None
+    for _ in range(repeat):
+        logic.station_details_cache.clear()
+        requests.get(f"{url}/__reset", timeout=5)
+
+        # queries without a recorded response fail with an HTTP error, which is
+        # reported as missing fixtures below
+        error = None
+        tracemalloc.start()
+        try:
+            start = time.perf_counter()
+            try:
+                result = function(*args)
+            except requests.RequestException as e:
+                error = e
+            wall_time = time.perf_counter() - start
+            peak_memory = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+        stats = requests.get(f"{url}/__stats", timeout=5).json()
+        if stats["missing"]:
+            raise RuntimeError(
+                f"{function.__name__}: {len(stats['missing'])} queries have no "
+                "recorded response, run with --record first"
+            ) from error
+        if error is not None:
+            raise error
+        runs.append(
+            {
+                "wall_time": wall_time,
+                "queries": stats["queries"],
+                "bytes": stats["bytes"],
+                "peak_memory": peak_memory,
+            }
+        )
+
+    return result, {
+        metric: statistics.median(run[metric] for run in runs) for metric in METRICS
+    }
+
+
+def run_scenario(url, repeat, points):
+    results = {}
+
+    common_routes, results["find_common_routes"] = measure(
+        url, repeat, logic.find_common_routes, *points
+    )
+    routes_with_change, results["find_routes_with_change"] = measure(
+        url, repeat, logic.find_routes_with_change, *points
+    )
+
+    if common_routes:
+        route = common_routes[0]["route"]
+        station = common_routes[0]["start_station"]
+    elif routes_with_change:
+        route = routes_with_change[0]["route_a"]
+        station = routes_with_change[0]["station_name_a"]
+    else:
+        return results
+
+    _, results["get_route_geometry"] = measure(
+        url, repeat, logic.get_route_geometry, route
+    )
+    _, results["get_station_details"] = measure(
+        url, repeat, logic.get_station_details, station
+    )
+    return results
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for scenario, functions in results.items():
+        for function, metrics in functions.items():
+            previous = baseline.get(scenario, {}).get(function)
+            if previous is None:
+                continue
+            for metric in METRICS:
+                if previous[metric] and metrics[metric] > previous[metric] * (
+                    1 + threshold
+                ):
+                    regressions.append(
+                        f"{scenario} / {function}: {metric} "
+                        f"{previous[metric]:.4g} -> {metrics[metric]:.4g}"
+                    )
+    return regressions
+
+
+def report(results, baseline):
+    print(
+        f"{'scenario':<16} {'function':<24} {'wall (s)':>10} "
+        f"{'queries':>8} {'bytes':>12} {'peak mem':>12} {'vs base':>8}"
+    )
+    for scenario, functions in results.items():
+        for function, metrics in functions.items():
+            previous = baseline.get(scenario, {}).get(function)
+            change = ""
+            if previous and previous["wall_time"]:
+                change = f"{metrics['wall_time'] / previous['wall_time'] - 1:+.0%}"
+            print(
+                f"{scenario:<16} {function:<24} {metrics['wall_time']:>10.3f} "
+                f"{metrics['queries']:>8.0f} {metrics['bytes']:>12.0f} "
+                f"{metrics['peak_memory']:>12.0f} {change:>8}"
+            )
+
+
+def main():
+    directory = os.path.dirname(__file__)
+    parser = argparse.ArgumentParser(
+        description="Benchmark the planner against recorded SPARQL responses"
+    )
+    parser.add_argument("--scenario", action="append", choices=sorted(SCENARIOS))
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--port", type=int, default=7020)
+    parser.add_argument("--fixtures", default=os.path.join(directory, "fixtures"))
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds")
+    parser.add_argument("--jitter", type=float, default=0.0, help="seconds")
+    parser.add_argument(
+        "--record",
+        action="store_true",
+        help="record missing responses from the real endpoints",
+    )
+    parser.add_argument("--baseline", default=os.path.join(directory, "baseline.json"))
+    parser.add_argument(
+        "--save-baseline", action="store_true", help="store these results as baseline"
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.2,
+        help="relative increase reported as a regression",
+    )
+    args = parser.parse_args()
+
+    if not args.record and not (
+        os.path.isdir(args.fixtures)
+        and any(name.endswith(".json") for name in os.listdir(args.fixtures))
+    ):
+        parser.error(
+            f"no recorded responses in {args.fixtures}, run with --record first"
+        )
+
+    process, url = start_stub(
+        args.port, args.fixtures, args.latency, args.jitter, args.record
+    )
+    try:
+        use_stub(url)
+        results = {
+            scenario: run_scenario(url, args.repeat, SCENARIOS[scenario]["points"])
+            for scenario in args.scenario or SCENARIOS
+        }
+    finally:
+        process.terminate()
+        process.wait()
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, encoding="utf-8") as file:
+            baseline = json.load(file)
+
+    report(results, baseline)
+
+    if args.save_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as file:
+            json.dump(results, file, indent=2)
+        return
+
+    regressions = compare(results, baseline, args.threshold)
+    for regression in regressions:
+        print(f"Regression: {regression}")
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+import argparse
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+import requests
+
+from cache import normalize_query
+
+UPSTREAMS = {
+    "/osm": "https://qlever.cs.uni-freiburg.de/api/osm-planet",
+    "/wikidata": "https://query.wikidata.org/sparql",
+}
+
+
+def fixture_key(path, query):
+    text = path + "\n" + normalize_query(query)
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class StubEndpoint(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, fixtures, latency=0.0, jitter=0.0, record=False):
+        super().__init__(address, StubHandler)
+        self.fixtures = fixtures
+        self.latency = latency
+        self.jitter = jitter
+        self.record = record
+        self.lock = threading.Lock()
+        self.reset()
+        os.makedirs(fixtures, exist_ok=True)
+
+    def reset(self):
+        with self.lock:
+            self.queries = 0
+            self.bytes = 0
+            self.missing = []
+
+    def stats(self):
+        with self.lock:
+            return {
+                "queries": self.queries,
+                "bytes": self.bytes,
+                "missing": list(self.missing),
+            }
+
+    def fixture_path(self, key):
+        return os.path.join(self.fixtures, f"{key}.json")
+
+    def load(self, path, query, accept):
+        fixture_path = self.fixture_path(fixture_key(path, query))
+        if os.path.exists(fixture_path):
+            with open(fixture_path, encoding="utf-8") as file:
+                return json.load(file)
+        if not self.record:
+            return None
+
+        response = requests.post(
+            UPSTREAMS[path],
+            data={"query": query},
+            headers={
+                "Accept": accept,
+                "User-Agent": "RailwayJourneyPlanner/1.0 (benchmark recorder)",
+            },
+            timeout=300,
+        )
+        response.raise_for_status()
+        fixture = {
+            "path": path,
+            "query": query,
+            "content_type": response.headers.get("Content-Type", ""),
+            "body": response.text,
+        }
+        with open(fixture_path, "w", encoding="utf-8") as file:
+            json.dump(fixture, file, ensure_ascii=False)
+        return fixture
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == "/__stats":
+            self.reply(200, "application/json", json.dumps(self.server.stats()))
+        elif self.path == "/__reset":
+            self.server.reset()
+            self.reply(200, "application/json", "{}")
+        else:
+            self.reply(404, "text/plain", "not found")
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        form = parse_qs(self.rfile.read(length).decode("utf-8"))
+        query = form.get("query", [""])[0]
+        if self.path not in UPSTREAMS:
+            self.reply(404, "text/plain", "unknown endpoint")
+            return
+
+        fixture = self.server.load(self.path, query, self.headers.get("Accept", ""))
+        if fixture is None:
+            with self.server.lock:
+                self.server.missing.append(fixture_key(self.path, query))
+            self.reply(500, "text/plain", "no recorded response for this query")
+            return
+
+        time.sleep(self.server.latency + random.uniform(0, self.server.jitter))
+        body = self.reply(200, fixture["content_type"], fixture["body"])
+        with self.server.lock:
+            self.server.queries += 1
+            self.server.bytes += len(body)
+
+    def reply(self, status, content_type, text):
+        body = text.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        return body
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Serve recorded SPARQL responses in place of the public endpoints"
+    )
+    parser.add_argument("--port", type=int, default=7020)
+    parser.add_argument(
+        "--fixtures", default=os.path.join(os.path.dirname(__file__), "fixtures")
+    )
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds")
+    parser.add_argument("--jitter", type=float, default=0.0, help="seconds")
+    parser.add_argument(
+        "--record",
+        action="store_true",
+        help="forward unknown queries to the real endpoints and store the responses",
+    )
+    args = parser.parse_args()
+
+    server = StubEndpoint(
+        ("127.0.0.1", args.port),
+        args.fixtures,
+        args.latency,
+        args.jitter,
+        args.record,
+    )
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
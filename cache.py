@@ -0,0 +1,160 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+HOUR = 60 * 60
+DAY = 24 * HOUR
+
+DEFAULT_TTLS = {
+    "geometry": 7 * DAY,
+    "intersections": 7 * DAY,
+    "transfers": 7 * DAY,
+    "near_point": 6 * HOUR,
+    "station_details": 1 * DAY,
+    "amenities": 1 * DAY,
+    "snapshot": 0,
+    "default": 1 * HOUR,
+}
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS entries (
+        key TEXT PRIMARY KEY,
+        kind TEXT NOT NULL,
+        value TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        created REAL NOT NULL,
+        accessed REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed);
+    CREATE TABLE IF NOT EXISTS queries (
+        key TEXT PRIMARY KEY,
+        endpoint TEXT NOT NULL,
+        kind TEXT NOT NULL,
+        query TEXT NOT NULL,
+        uses INTEGER NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS queries_uses ON queries (endpoint, uses);
+"""
+
+
+def normalize_query(query):
+    return " ".join(query.split())
+
+
+class QueryCache:
+    def __init__(self, path, max_bytes=512 * 1024 * 1024, ttls=None):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript(SCHEMA)
+        self.max_bytes = max_bytes
+        self.ttls = dict(DEFAULT_TTLS, **(ttls or {}))
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def ttl(self, kind):
+        return self.ttls.get(kind, self.ttls["default"])
+
+    @staticmethod
+    def key(endpoint, query):
+        text = endpoint + "\n" + normalize_query(query)
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def get(self, endpoint, query, kind="default"):
+        ttl = self.ttl(kind)
+        if ttl <= 0:
+            return None
+
+        key = self.key(endpoint, query)
+        now = time.time()
+        with self.lock:
+            row = self.db.execute(
+                "SELECT value, created FROM entries WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or row[1] + ttl < now:
+                self.misses += 1
+                return None
+            with self.db:
+                self.db.execute(
+                    "UPDATE entries SET accessed = ? WHERE key = ?", (now, key)
+                )
+                self.db.execute(
+                    "UPDATE queries SET uses = uses + 1 WHERE key = ?", (key,)
+                )
+            self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, endpoint, query, value, kind="default"):
+        if self.ttl(kind) <= 0:
+            return
+
+        key = self.key(endpoint, query)
+        data = json.dumps(value)
+        now = time.time()
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?)",
+                (key, kind, data, len(data), now, now),
+            )
+            self.db.execute(
+                """
+                INSERT INTO queries VALUES (?, ?, ?, ?, 1)
+                ON CONFLICT (key) DO UPDATE SET uses = uses + 1
+                """,
+                (key, endpoint, kind, query),
+            )
+            self.evict()
+
+    def evict(self):
+        total = self.db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM entries"
+        ).fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for key, size in self.db.execute(
+            "SELECT key, size FROM entries ORDER BY accessed"
+        ).fetchall():
+            self.db.execute("DELETE FROM entries WHERE key = ?", (key,))
+            self.db.execute("DELETE FROM queries WHERE key = ?", (key,))
+            self.evictions += 1
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+    def clear(self):
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM entries")
+            self.db.execute("DELETE FROM queries")
+
+    def frequent_queries(self, endpoint, limit=100, kinds=None):
+        kinds = [kind for kind in kinds or self.ttls if self.ttl(kind) > 0]
+        placeholders = ", ".join("?" for _ in kinds)
+        with self.lock:
+            return self.db.execute(
+                f"""
+                SELECT query, kind FROM queries
+                WHERE endpoint = ? AND kind IN ({placeholders})
+                ORDER BY uses DESC
+                LIMIT ?
+                """,
+                (endpoint, *kinds, limit),
+            ).fetchall()
+
+    def stats(self):
+        with self.lock:
+            entries, size = self.db.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries"
+            ).fetchone()
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": entries,
+            "bytes": size,
+        }
@@ -0,0 +1,84 @@
+import contextvars
+import json
+import threading
+from contextlib import contextmanager
+
+import requests
+
+from transport import SparqlTransport
+
+FAILOVER_ERRORS = (requests.Timeout, requests.ConnectionError)
+
+current_region = contextvars.ContextVar("current_region", default=None)
+
+
+class Endpoint:
+    def __init__(
+        self, url, result_format="tsv", max_concurrency=4, timeout=60, region=None
+    ):
+        self.url = url
+        self.region = region
+        self.transport = SparqlTransport(
+            url, result_format, timeout=timeout, pool_size=max_concurrency
+        )
+        self.semaphore = threading.BoundedSemaphore(max_concurrency)
+
+
+class Region:
+    def __init__(self, name, url, bbox, timeout=10, max_concurrency=4):
+        self.name = name
+        self.url = url
+        self.bbox = bbox
+        self.timeout = timeout
+        self.max_concurrency = max_concurrency
+
+    def contains(self, longitude, latitude):
+        min_lon, min_lat, max_lon, max_lat = self.bbox
+        return min_lon <= longitude <= max_lon and min_lat <= latitude <= max_lat
+
+
+def load_regions(path):
+    with open(path, encoding="utf-8") as file:
+        return [Region(**region) for region in json.load(file)]
+
+
+def find_region(regions, points):
+    for region in regions:
+        if all(region.contains(longitude, latitude) for longitude, latitude in points):
+            return region.name
+    return None
+
+
+@contextmanager
+def routed(regions, *points):
+    # queries sent inside the block go to the region that contains all points,
+    # or to the default endpoint when there is none
+    token = current_region.set(find_region(regions, points))
+    try:
+        yield
+    finally:
+        current_region.reset(token)
+
+
+def warm_up(connection, cache, limit=100, kinds=None):
+    # only the local regional servers are warmed, the shared public endpoint and
+    # its fallbacks are left alone
+    for endpoint in connection.regional_endpoints.values():
+        for query, kind in cache.frequent_queries(endpoint.url, limit, kinds):
+            try:
+                with endpoint.semaphore:
+                    for _ in endpoint.transport.rows(query):
+                        pass
+            except (requests.RequestException, ValueError):
+                continue
+
+
+def start_warm_up(connection, cache, limit=100, kinds=None):
+    thread = threading.Thread(
+        target=warm_up,
+        args=(connection, cache, limit, kinds),
+        name="sparql-warm-up",
+        daemon=True,
+    )
+    thread.start()
+    return thread
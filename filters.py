@@ -0,0 +1,104 @@
+import numpy as np
+import pandas as pd
+
+
+class RouteFilter:
+    def __init__(self, routes):
+        self.routes = routes
+        frame = pd.DataFrame(
+            {
+                "start_station": [route["start_station"] for route in routes],
+                "end_station": [route["end_station"] for route in routes],
+                "operator": [route.get("operator") or "" for route in routes],
+                "route_name": [route["route_name"] for route in routes],
+            },
+            dtype="category",
+        )
+        self.distances = np.array(
+            [route["total_distance"] for route in routes], dtype=float
+        )
+        self.categories = {
+            column: list(frame[column].cat.categories) for column in frame.columns
+        }
+        self.codes = {
+            column: frame[column].cat.codes.to_numpy() for column in frame.columns
+        }
+        stations = len(self.categories["end_station"])
+        self.codes["stations"] = (
+            self.codes["start_station"].astype(np.int64) * stations
+            + self.codes["end_station"]
+        )
+
+        self.values = {}
+        self.masks = {}
+
+    def update(
+        self,
+        max_distance=None,
+        start_station=None,
+        end_station=None,
+        operators=None,
+        other=True,
+    ):
+        # only the masks of filters whose value changed are recomputed
+        values = {
+            "max_distance": max_distance,
+            "start_station": start_station,
+            "end_station": end_station,
+            "operator": (None if operators is None else frozenset(operators), other),
+        }
+        for name, value in values.items():
+            if name not in self.values or self.values[name] != value:
+                self.values[name] = value
+                self.masks[name] = self.mask(name, value)
+
+    def mask(self, name, value):
+        if name == "max_distance":
+            if value is None:
+                return None
+            return self.distances <= value
+        if name == "operator":
+            operators, other = value
+            if operators is None and other:
+                return None
+            allowed = np.zeros(len(self.categories["operator"]), dtype=bool)
+            for i, operator in enumerate(self.categories["operator"]):
+                if operator:
+                    allowed[i] = operators is None or operator in operators
+                else:
+                    allowed[i] = other
+            return allowed[self.codes["operator"]]
+        if value is None:
+            return None
+        if value not in self.categories[name]:
+            return np.zeros(len(self.routes), dtype=bool)
+        return self.codes[name] == self.categories[name].index(value)
+
+    def combined(self, exclude=None):
+        mask = np.ones(len(self.routes), dtype=bool)
+        for name, value in self.masks.items():
+            if name != exclude and value is not None:
+                mask &= value
+        return mask
+
+    def count(self, facet, mask):
+        counts = np.bincount(
+            self.codes[facet][mask], minlength=len(self.categories[facet])
+        )
+        return dict(zip(self.categories[facet], counts.tolist()))
+
+    def facet_counts(self, facet):
+        # counts under every filter except the facet's own, as faceted search shows them
+        return self.count(facet, self.combined(exclude=facet))
+
+    def first_per(self, indices, key):
+        _, first = np.unique(self.codes[key][indices], return_index=True)
+        return indices[np.sort(first)]
+
+    def apply(self, unique_stations=False, unique_route_names=False):
+        indices = np.flatnonzero(self.combined())
+        if unique_stations:
+            indices = self.first_per(indices, "stations")
+        if unique_route_names:
+            indices = self.first_per(indices, "route_name")
+        return [self.routes[i] for i in indices]
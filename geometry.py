@@ -0,0 +1,113 @@
+import os
+from functools import lru_cache
+
+import numpy as np
+import shapely
+from shapely import wkt
+from shapely.ops import linemerge, substring
+
+from geometry_store import GeometryStore
+from instrumentation import traced
+from logic import get_route_geometry, submit
+
+geometry_store = GeometryStore(
+    os.environ.get("GEOMETRY_STORE_PATH", ".cache/geometries"),
+    int(os.environ.get("GEOMETRY_STORE_OPEN_FILES", "256")),
+)
+geometry_store.remove_expired()
+
+
+def route_lines(geometry):
+    if geometry.geom_type == "LineString":
+        return [geometry]
+    if geometry.geom_type not in ("MultiLineString", "GeometryCollection"):
+        return []
+
+    lines = []
+    for geom in geometry.geoms:
+        lines.extend(route_lines(geom))
+    if len(lines) < 2:
+        return lines
+
+    merged = linemerge(lines)
+    if merged.geom_type == "LineString":
+        return [merged]
+    return list(merged.geoms)
+
+
+def clip_lines(lines, start, end):
+    # the stations may lie on different parts of a route that does not merge
+    # into one line, the part between them is then unknown and the whole route
+    # is kept
+    if not lines:
+        return lines
+    line = min(lines, key=lambda line: line.distance(start))
+    if line is not min(lines, key=lambda line: line.distance(end)):
+        return lines
+    start_offset, end_offset = sorted((line.project(start), line.project(end)))
+    if start_offset == end_offset:
+        return []
+    return [substring(line, start_offset, end_offset)]
+
+
+def tolerance_for_zoom(zoom, pixels=1.0):
+    return pixels * 360 / (256 * 2**zoom)
+
+
+def to_coordinates(lines):
+    return [shapely.get_coordinates(line)[:, ::-1] for line in lines]
+
+
+def from_coordinates(coordinates):
+    return [shapely.linestrings(line[:, ::-1]) for line in coordinates]
+
+
+@lru_cache(maxsize=64)
+def load_route_lines(route):
+    key = geometry_store.key(route)
+    if key not in geometry_store:
+        lines = route_lines(wkt.loads(get_route_geometry(route)))
+        geometry_store.put(key, to_coordinates(lines))
+    return from_coordinates(geometry_store.lines(key))
+
+
+@traced
+def get_route_segment(route, start_geometry=None, end_geometry=None, tolerance=0.0):
+    if start_geometry is None or end_geometry is None:
+        start_geometry = end_geometry = None
+    key = geometry_store.key(route, start_geometry, end_geometry, f"{tolerance:.6g}")
+    if key in geometry_store:
+        return key
+
+    lines = load_route_lines(route)
+    if start_geometry is not None:
+        lines = clip_lines(lines, wkt.loads(start_geometry), wkt.loads(end_geometry))
+    if tolerance > 0:
+        lines = [line.simplify(tolerance, preserve_topology=False) for line in lines]
+    geometry_store.put(key, to_coordinates(lines))
+    return key
+
+
+def get_route_segments(segments, tolerance=0.0):
+    segments = list(dict.fromkeys(segments))
+    futures = [submit(get_route_segment, *segment, tolerance) for segment in segments]
+    return {segment: future.result() for segment, future in zip(segments, futures)}
+
+
+def feature_collection(segments, precision=5):
+    features = []
+    for key, properties in segments:
+        lines = [
+            np.round(line[:, ::-1], precision).tolist()
+            for line in geometry_store.lines(key)
+            if len(line) > 1
+        ]
+        if lines:
+            features.append(
+                {
+                    "type": "Feature",
+                    "properties": properties,
+                    "geometry": {"type": "MultiLineString", "coordinates": lines},
+                }
+            )
+    return {"type": "FeatureCollection", "features": features}
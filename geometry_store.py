@@ -0,0 +1,99 @@
+import hashlib
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from cache import DEFAULT_TTLS
+
+
+class GeometryStore:
+    def __init__(self, directory, max_loaded=256, ttl=DEFAULT_TTLS["geometry"]):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.max_loaded = max_loaded
+        self.ttl = ttl
+        # key -> (coords memmap, offsets, mtime of the coords file)
+        self.loaded = OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(*parts):
+        text = "|".join("" if part is None else str(part) for part in parts)
+        return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+    def path(self, key, name):
+        return os.path.join(self.directory, f"{key}.{name}.npy")
+
+    def modified(self, key):
+        try:
+            return os.path.getmtime(self.path(key, "coords"))
+        except FileNotFoundError:
+            return None
+
+    def fresh(self, mtime):
+        return mtime is not None and (self.ttl <= 0 or mtime + self.ttl > time.time())
+
+    def __contains__(self, key):
+        # entries older than the TTL count as missing and are written again
+        with self.lock:
+            entry = self.loaded.get(key)
+        if entry is not None and self.fresh(entry[2]):
+            return True
+        return self.fresh(self.modified(key))
+
+    def write(self, path, array):
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".npy")
+        with os.fdopen(fd, "wb") as file:
+            np.save(file, array)
+        os.replace(tmp, path)
+
+    def put(self, key, lines):
+        lines = [np.asarray(line, dtype=np.float64).reshape(-1, 2) for line in lines]
+        offsets = np.zeros(len(lines) + 1, dtype=np.int64)
+        np.cumsum([len(line) for line in lines], out=offsets[1:])
+        coords = np.concatenate(lines) if lines else np.empty((0, 2))
+
+        # coords is written last so that its presence marks a complete entry
+        self.write(self.path(key, "offsets"), offsets)
+        self.write(self.path(key, "coords"), coords)
+        with self.lock:
+            self.loaded.pop(key, None)
+
+    def get(self, key):
+        # open memmaps hold a file descriptor each, only the most recently used
+        # max_loaded entries are kept open
+        with self.lock:
+            entry = self.loaded.get(key)
+            if entry is None:
+                entry = self.loaded[key] = (
+                    np.load(self.path(key, "coords"), mmap_mode="r"),
+                    np.load(self.path(key, "offsets")),
+                    self.modified(key),
+                )
+            self.loaded.move_to_end(key)
+            while len(self.loaded) > self.max_loaded:
+                self.loaded.popitem(last=False)
+            return entry[:2]
+
+    def remove_expired(self):
+        if self.ttl <= 0:
+            return 0
+        removed = 0
+        deadline = time.time() - self.ttl
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                if name.endswith(".npy") and os.path.getmtime(path) < deadline:
+                    os.remove(path)
+                    removed += 1
+            except FileNotFoundError:
+                continue
+        return removed
+
+    def lines(self, key):
+        coords, offsets = self.get(key)
+        return [coords[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
@@ -0,0 +1,203 @@
+import contextvars
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sinks = []
+
+current_recording = contextvars.ContextVar("current_recording", default=None)
+current_span = contextvars.ContextVar("current_span", default=None)
+
+
+def add_sink(sink):
+    sinks.append(sink)
+    return sink
+
+
+def remove_sink(sink):
+    sinks.remove(sink)
+
+
+def emit(event):
+    recording = current_recording.get()
+    if recording is not None:
+        recording.append(event)
+    for sink in sinks:
+        sink(event)
+
+
+@contextmanager
+def record(events=None):
+    events = [] if events is None else events
+    token = current_recording.set(events)
+    try:
+        yield events
+    finally:
+        current_recording.reset(token)
+
+
+def new_event(type_, name, fields):
+    return {
+        "type": type_,
+        "name": name,
+        "parent": current_span.get(),
+        "thread": threading.current_thread().name,
+        "start": time.time(),
+        **fields,
+    }
+
+
+@contextmanager
+def event_span(type_, name, **fields):
+    event = new_event(type_, name, fields)
+    token = current_span.set(name)
+    started = time.perf_counter()
+    try:
+        yield event
+    except BaseException as e:
+        event["error"] = type(e).__name__
+        raise
+    finally:
+        event["duration"] = time.perf_counter() - started
+        current_span.reset(token)
+        emit(event)
+
+
+def iter_event_span(type_, name, iterate, **fields):
+    # spans around generators: iterate(event) runs in a context of its own, so
+    # neither the span nor anything else it sets leaks into the caller's context
+    # between items, and the generator may be closed from any context
+    event = new_event(type_, name, fields)
+    context = contextvars.copy_context()
+    context.run(current_span.set, name)
+    started = time.perf_counter()
+    try:
+        items = context.run(iterate, event)
+        while True:
+            try:
+                item = context.run(next, items)
+            except StopIteration:
+                return
+            yield item
+    except GeneratorExit:
+        event["cancelled"] = True
+        context.run(items.close)
+        raise
+    except BaseException as e:
+        event["error"] = type(e).__name__
+        raise
+    finally:
+        event["duration"] = time.perf_counter() - started
+        context.run(emit, event)
+
+
+def span(name, **fields):
+    return event_span("span", name, **fields)
+
+
+QUERY_FIELDS = {"rows": 0, "bytes": 0, "cache": "off"}
+
+
+def query_span(endpoint, kind):
+    return event_span("query", kind, endpoint=endpoint, **QUERY_FIELDS)
+
+
+def traced(function):
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        with span(function.__name__):
+            return function(*args, **kwargs)
+
+    return wrapper
+
+
+def traced_iter(function):
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        return iter_event_span(
+            "span", function.__name__, lambda event: function(*args, **kwargs)
+        )
+
+    return wrapper
+
+
+class LoggingSink:
+    def __init__(self, logger="planner.instrumentation", level=logging.INFO):
+        self.logger = logging.getLogger(logger)
+        self.level = level
+
+    def __call__(self, event):
+        self.logger.log(self.level, json.dumps(event, default=str))
+
+
+class PrometheusSink:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+
+    def increment(self, metric, labels, value=1):
+        key = (metric, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def __call__(self, event):
+        if event["type"] == "query":
+            labels = {"kind": event["name"], "cache": event["cache"]}
+            self.increment("planner_queries_total", labels)
+            self.increment("planner_query_seconds_sum", labels, event["duration"])
+            self.increment("planner_query_rows_total", labels, event["rows"])
+            self.increment("planner_query_bytes_total", labels, event["bytes"])
+            if "error" in event:
+                self.increment("planner_query_errors_total", {"kind": event["name"]})
+        else:
+            labels = {"name": event["name"]}
+            self.increment("planner_span_count", labels)
+            self.increment("planner_span_seconds_sum", labels, event["duration"])
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for (metric, labels), value in sorted(self.counters.items()):
+                label_text = ",".join(f'{k}="{v}"' for k, v in labels)
+                lines.append(f"{metric}{{{label_text}}} {value}")
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port, host="127.0.0.1"):
+        # the endpoint is unauthenticated, it only listens on other interfaces
+        # when asked to
+        sink = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = sink.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+def configure_from_environment():
+    names = os.environ.get("PLANNER_INSTRUMENTATION", "")
+    for name in filter(None, (name.strip() for name in names.split(","))):
+        if name == "log":
+            add_sink(LoggingSink())
+        elif name == "prometheus":
+            sink = add_sink(PrometheusSink())
+            if os.environ.get("PLANNER_METRICS_PORT"):
+                sink.serve(
+                    int(os.environ["PLANNER_METRICS_PORT"]),
+                    os.environ.get("PLANNER_METRICS_HOST", "127.0.0.1"),
+                )
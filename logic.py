@@ -1,10 +1,65 @@
-from SPARQLWrapper import SPARQLWrapper, JSON
+import contextvars
+import itertools
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import numpy as np
+import shapely
+
+import instrumentation
+from cache import QueryCache
+from endpoints import (
+    FAILOVER_ERRORS,
+    Endpoint,
+    current_region,
+    load_regions,
+    routed,
+    start_warm_up,
+)
+from instrumentation import query_span, traced, traced_iter
+from offsets import StationOffsets, ride_distances
+from spatial import StationIndex
+from transfers import TransferTable
+from transport import SparqlTransport
+from walking import WalkingGraph, WalkingRouter
 
 
 class SparqlConnection:
-    def __init__(self):
-        self.ENDPOINT_URL = "https://qlever.cs.uni-freiburg.de/api/osm-planet"
-        self.sparql = SPARQLWrapper(self.ENDPOINT_URL)
+    def __init__(
+        self,
+        cache=None,
+        max_concurrency=4,
+        result_format="tsv",
+        endpoint="https://qlever.cs.uni-freiburg.de/api/osm-planet",
+        fallbacks=(),
+        regions=(),
+    ):
+        self.ENDPOINT_URL = endpoint
+        self.cache = cache
+        self.regions = list(regions)
+        self.default_endpoints = [
+            Endpoint(url, result_format, max_concurrency)
+            for url in (endpoint, *fallbacks)
+        ]
+        self.regional_endpoints = {
+            region.name: Endpoint(
+                region.url,
+                result_format,
+                region.max_concurrency,
+                region.timeout,
+                region.name,
+            )
+            for region in self.regions
+        }
+        self.endpoints = [
+            *self.regional_endpoints.values(),
+            *self.default_endpoints,
+        ]
         self.header = """
             PREFIX rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#>
             PREFIX geo: <http://www.opengis.net/ont/geosparql#>
@@ -17,36 +72,348 @@ class SparqlConnection:
             PREFIX ogc: <http://www.opengis.net/rdf#>
         """
 
-    def query(self, q):
-        self.sparql.setQuery(self.header + q)
-        self.sparql.setReturnFormat(JSON)
-        result = self.sparql.query().convert()
-        result = result["results"]["bindings"]
-        result = list(map(lambda x: {k: v["value"] for k, v in x.items()}, result))
+    def routed(self, *points):
+        return routed(self.regions, *points)
+
+    def route(self):
+        region = self.regional_endpoints.get(current_region.get())
+        if region is None:
+            return self.default_endpoints
+        return [region, *self.default_endpoints]
+
+    def query(self, q, kind="default"):
+        q = self.header + q
+        *fallbacks, last = self.route()
+        for endpoint in fallbacks:
+            try:
+                return self.query_endpoint(endpoint, q, kind)
+            except FAILOVER_ERRORS:
+                continue
+        return self.query_endpoint(last, q, kind)
+
+    def query_endpoint(self, endpoint, q, kind):
+        with query_span(endpoint.url, kind) as event:
+            if self.cache is not None:
+                result = self.cache.get(endpoint.url, q, kind)
+                event["cache"] = "miss" if result is None else "hit"
+                if result is not None:
+                    event["rows"] = len(result)
+                    return result
+
+            with endpoint.semaphore:
+                result = list(endpoint.transport.rows(q, event))
+            event["rows"] = len(result)
+
+        if self.cache is not None:
+            self.cache.put(endpoint.url, q, result, kind)
         return result
 
 
 class WikidataConnection:
-    def __init__(self):
-        self.ENDPOINT_URL = "https://query.wikidata.org/sparql"
-        self.sparql = SPARQLWrapper(self.ENDPOINT_URL)
-
-    def query(self, q):
-        self.sparql.setQuery(q)
-        self.sparql.setReturnFormat(JSON)
-        result = self.sparql.query().convert()
-        result = result["results"]["bindings"]
-        result = [{k: v.get("value", "") for k, v in item.items()} for item in result]
+    def __init__(
+        self,
+        cache=None,
+        max_concurrency=2,
+        result_format="json",
+        endpoint="https://query.wikidata.org/sparql",
+    ):
+        self.ENDPOINT_URL = endpoint
+        self.transport = SparqlTransport(
+            self.ENDPOINT_URL, result_format, pool_size=max_concurrency
+        )
+        self.cache = cache
+        self.semaphore = threading.BoundedSemaphore(max_concurrency)
+
+    def query(self, q, kind="default"):
+        with query_span(self.ENDPOINT_URL, kind) as event:
+            if self.cache is not None:
+                result = self.cache.get(self.ENDPOINT_URL, q, kind)
+                event["cache"] = "miss" if result is None else "hit"
+                if result is not None:
+                    event["rows"] = len(result)
+                    return result
+
+            with self.semaphore:
+                result = list(self.transport.rows(q, event))
+            event["rows"] = len(result)
+
+        if self.cache is not None:
+            self.cache.put(self.ENDPOINT_URL, q, result, kind)
         return result
 
 
-wikidata_connection = WikidataConnection()
+query_cache = None
+if os.environ.get("SPARQL_CACHE", "1") != "0":
+    query_cache = QueryCache(
+        os.environ.get("SPARQL_CACHE_PATH", ".cache/sparql.sqlite"),
+        max_bytes=int(os.environ.get("SPARQL_CACHE_MAX_MB", "512")) * 1024 * 1024,
+    )
 
-connection = SparqlConnection()
+wikidata_connection = WikidataConnection(
+    query_cache,
+    int(os.environ.get("WIKIDATA_MAX_CONCURRENCY", "2")),
+    os.environ.get("WIKIDATA_RESULT_FORMAT", "json"),
+)
 
+connection = SparqlConnection(
+    query_cache,
+    int(os.environ.get("SPARQL_MAX_CONCURRENCY", "4")),
+    os.environ.get("SPARQL_RESULT_FORMAT", "tsv"),
+    os.environ.get(
+        "SPARQL_ENDPOINT", "https://qlever.cs.uni-freiburg.de/api/osm-planet"
+    ),
+    [url for url in os.environ.get("SPARQL_FALLBACK_ENDPOINTS", "").split(",") if url],
+    (
+        load_regions(os.environ["SPARQL_REGIONS"])
+        if os.environ.get("SPARQL_REGIONS")
+        else ()
+    ),
+)
 
-def find_routes_near_point(longitude, latitude, radius=5):
-    query = f"""
+if query_cache is not None and int(os.environ.get("SPARQL_WARM_UP", "0")):
+    start_warm_up(
+        connection,
+        query_cache,
+        int(os.environ["SPARQL_WARM_UP"]),
+        ["near_point", "geometry", "intersections", "transfers"],
+    )
+
+executor = ThreadPoolExecutor(max_workers=16)
+
+instrumentation.configure_from_environment()
+
+station_index = None
+if os.environ.get("STATION_INDEX"):
+    station_index = StationIndex.load(os.environ["STATION_INDEX"])
+
+transfer_table = None
+if os.environ.get("TRANSFER_TABLE"):
+    transfer_table = TransferTable.load(os.environ["TRANSFER_TABLE"])
+
+# candidates on routes or stations missing from the offsets are ranked after the
+# ones whose ride distance is known
+UNKNOWN_RIDE_KM = 1e6
+
+
+def ranking_score(walk, ride):
+    # walking plus ride distance; rides that are unknown (None or inf) count as
+    # UNKNOWN_RIDE_KM
+    ride = np.asarray(np.inf if ride is None else ride, dtype=np.float64)
+    return walk + np.where(np.isfinite(ride), ride, UNKNOWN_RIDE_KM)
+
+
+station_offsets = None
+ordered_routes = os.environ.get("STATION_OFFSETS_ORDERED") == "1"
+if os.environ.get("STATION_OFFSETS"):
+    station_offsets = StationOffsets.load(os.environ["STATION_OFFSETS"])
+
+walking_router = None
+if os.environ.get("WALKING_GRAPH"):
+    walking_router = WalkingRouter(
+        WalkingGraph.load(os.environ["WALKING_GRAPH"]),
+        float(os.environ.get("WALKING_MAX_KM", "10")),
+        max_nodes=int(os.environ.get("WALKING_CACHE_NODES", "2000000")),
+    )
+
+
+def submit(function, *args):
+    context = contextvars.copy_context()
+    return executor.submit(context.run, function, *args)
+
+
+def run_concurrently(*calls):
+    futures = [submit(function, *args) for function, *args in calls]
+    return [future.result() for future in futures]
+
+
+class Cancellation:
+    def __init__(self, timeout=None):
+        self.deadline = None if timeout is None else time.monotonic() + timeout
+        self.event = threading.Event()
+
+    def cancel(self):
+        self.event.set()
+
+    @property
+    def cancelled(self):
+        return self.event.is_set() or (
+            self.deadline is not None and time.monotonic() >= self.deadline
+        )
+
+
+def iter_completed(calls, token=None, poll=0.1):
+    # yields (index, result) in completion order; calls still pending when the
+    # token fires or the consumer stops iterating are cancelled
+    futures = {submit(function, *args): i for i, (function, *args) in enumerate(calls)}
+    pending = set(futures)
+    try:
+        while pending:
+            if token is not None and token.cancelled:
+                return
+            done, pending = wait(
+                pending,
+                timeout=None if token is None else poll,
+                return_when=FIRST_COMPLETED,
+            )
+            for future in done:
+                yield futures[future], future.result()
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+class AdaptiveSearch:
+    def __init__(
+        self,
+        radii=(0.5, 1, 2, 5, 10, 20),
+        row_limit=500,
+        min_routes=10,
+        min_stations=2,
+        enough=None,
+    ):
+        self.radii = radii
+        self.row_limit = row_limit
+        self.min_routes = min_routes
+        self.min_stations = min_stations
+        self.enough = enough or self.enough_routes
+
+    def enough_routes(self, rows):
+        return (
+            len({row["route"] for row in rows}) >= self.min_routes
+            and len({row["station"] for row in rows}) >= self.min_stations
+        )
+
+    def search(self, ring, longitude, latitude, radius=None):
+        # each step only fetches the ring between the previous and the next radius,
+        # so the rows stay ordered by distance and nothing is fetched twice; the
+        # caller's radius is the outermost ring
+        radii = self.radii
+        if radius is not None:
+            radii = [step for step in self.radii if step < radius] + [radius]
+        rows, inner = [], None
+        for outer in radii:
+            rows.extend(
+                ring(longitude, latitude, inner, outer, self.row_limit - len(rows))
+            )
+            inner = outer
+            if len(rows) >= self.row_limit or self.enough(rows):
+                break
+        return rows
+
+
+DEFAULT_RADIUS_KM = 5
+
+adaptive_search = None
+if os.environ.get("NEAR_POINT_ADAPTIVE") == "1":
+    adaptive_search = AdaptiveSearch(
+        tuple(
+            float(radius)
+            for radius in os.environ.get("NEAR_POINT_RADII", "0.5,1,2,5,10,20").split(
+                ","
+            )
+        ),
+        int(os.environ.get("NEAR_POINT_ROW_LIMIT", "500")),
+        int(os.environ.get("NEAR_POINT_MIN_ROUTES", "10")),
+        int(os.environ.get("NEAR_POINT_MIN_STATIONS", "2")),
+    )
+
+
+@traced
+def find_routes_near_point(longitude, latitude, radius=None):
+    # without a radius the adaptive search widens through all its radii and the
+    # fixed search uses DEFAULT_RADIUS_KM
+    fixed_radius = DEFAULT_RADIUS_KM if radius is None else radius
+    with connection.routed((longitude, latitude)):
+        if adaptive_search is not None:
+            results = adaptive_search.search(
+                routes_in_ring, longitude, latitude, radius
+            )
+        elif station_index is not None:
+            stations = station_index.within(longitude, latitude, fixed_radius)
+            results = find_routes_near_stations(stations)
+        else:
+            query = routes_near_point_query(longitude, latitude, fixed_radius)
+            results = connection.query(query, kind="near_point")
+    return walking_distances(longitude, latitude, results)
+
+
+def walking_distances(longitude, latitude, rows):
+    # replaces the straight-line distance to each station with the walking
+    # distance and orders the rows by it; stations away from the footways keep
+    # the straight-line distance and stations that cannot be reached on foot are
+    # left out
+    if walking_router is None:
+        return rows
+
+    rows = list(rows)
+    geometries = list(dict.fromkeys(row["stationGeometry"] for row in rows))
+    points = shapely.centroid(shapely.from_wkt(geometries))
+    walked = dict(
+        zip(
+            geometries,
+            walking_router.distances(
+                longitude, latitude, shapely.get_x(points), shapely.get_y(points)
+            ),
+        )
+    )
+
+    results = []
+    for row in rows:
+        distance = walked[row["stationGeometry"]]
+        if np.isnan(distance):
+            results.append(row)
+        elif np.isfinite(distance):
+            results.append(dict(row, distance=round(float(distance), 3)))
+    results.sort(key=lambda row: float(row["distance"]))
+    return results
+
+
+def routes_in_ring(longitude, latitude, inner, outer, limit):
+    # the limit counts route-station rows, the routes of the last station are
+    # always returned in full
+    if station_index is not None:
+        stations = [
+            station
+            for station in station_index.within(longitude, latitude, outer)
+            if inner is None or station["distance"] > inner
+        ]
+        rows = find_routes_near_stations(stations)
+        if len(rows) <= limit:
+            return rows
+        end = limit
+        while end < len(rows) and rows[end]["station"] == rows[limit - 1]["station"]:
+            end += 1
+        return rows[:end]
+
+    query = routes_near_point_query(longitude, latitude, outer, inner, limit)
+    results = connection.query(query, kind="near_point")
+    if len(results) < limit:
+        return results
+
+    # the stations at the distance where the limit cut the rows may have lost
+    # some of their routes, they are looked up again
+    last = float(results[-1]["distance"])
+    cut = [row for row in results if float(row["distance"]) == last]
+    stations = {
+        row["station"]: {
+            "station": row["station"],
+            "stationName": row["stationName"],
+            "stationGeometry": row["stationGeometry"],
+            "distance": row["distance"],
+        }
+        for row in cut
+    }
+    return [row for row in results if float(row["distance"]) != last] + (
+        find_routes_near_stations(list(stations.values()))
+    )
+
+
+def routes_near_point_query(longitude, latitude, radius, inner=None, limit=None):
+    distance_filter = f"?distance <= {radius}"
+    if inner is not None:
+        distance_filter = f"?distance > {inner} && {distance_filter}"
+    limit_clause = f"LIMIT {limit}" if limit is not None else ""
+    return f"""
         SELECT ?route ?routeName ?stationGeometry ?station ?stationName ?distance ?operator WHERE {{
             BIND ("POINT({longitude} {latitude})"^^geo:wktLiteral AS ?referencePoint)
 
@@ -54,7 +421,7 @@ def find_routes_near_point(longitude, latitude, radius=5):
                      osmkey:name ?stationName ;
                      geo:hasGeometry/geo:asWKT ?stationGeometry .
             BIND (geof:distance(?referencePoint, ?stationGeometry) AS ?distance)
-            FILTER (?distance <= {radius})
+            FILTER ({distance_filter})
 
             ?route ogc:sfContains ?station ;
                    osmkey:route ?routeType ;
@@ -63,79 +430,440 @@ def find_routes_near_point(longitude, latitude, radius=5):
             OPTIONAL {{ ?route osmkey:operator ?operator }}
         }}
         ORDER BY ?distance
+        {limit_clause}
+    """
+
+
+@traced
+def find_routes_near_stations(stations):
+    station_routes = {}
+    for chunk in chunks([station["station"] for station in stations], 500):
+        for row in get_station_routes(chunk):
+            station_routes.setdefault(row["station"], []).append(row)
+
+    results = []
+    for station in stations:
+        for route in station_routes.get(station["station"], []):
+            row = {
+                "route": route["route"],
+                "routeName": route["routeName"],
+                "stationGeometry": station["stationGeometry"],
+                "station": station["station"],
+                "stationName": station["stationName"],
+                "distance": station["distance"],
+            }
+            if "operator" in route:
+                row["operator"] = route["operator"]
+            results.append(row)
+    return results
+
+
+def get_station_routes(stations):
+    values = " ".join(f"<{station}>" for station in stations)
+    query = f"""
+        SELECT ?route ?routeName ?station ?operator WHERE {{
+            VALUES ?station {{ {values} }}
+
+            ?route ogc:sfContains ?station ;
+                   osmkey:route ?routeType ;
+                   osmkey:name ?routeName ;
+            FILTER (?routeType IN ("train", "railway"))
+            OPTIONAL {{ ?route osmkey:operator ?operator }}
+        }}
     """
 
-    results = connection.query(query)
+    results = connection.query(query, kind="near_point")
     return results
 
 
-def find_common_routes(lat1, lon1, lat2, lon2, radius=5):
-    routes_place_a = find_routes_near_point(lon1, lat1, radius)
-    routes_place_b = find_routes_near_point(lon2, lat2, radius)
+@traced
+def find_common_routes(lat1, lon1, lat2, lon2, radius=None, limit=None, best_per=None):
+    routes_place_a, routes_place_b = run_concurrently(
+        (find_routes_near_point, lon1, lat1, radius),
+        (find_routes_near_point, lon2, lat2, radius),
+    )
 
-    routes_a_ids = set(route["route"] for route in routes_place_a)
-    routes_b_ids = set(route["route"] for route in routes_place_b)
+    return match_common_routes(routes_place_a, routes_place_b, limit, best_per)
+
+
+def group_by_route(routes, codes):
+    groups = {}
+    for route in routes:
+        groups.setdefault(route["route"], []).append(route)
+    return {
+        route: (
+            rows,
+            np.array([float(row["distance"]) for row in rows]),
+            np.array(
+                [codes.setdefault(row["stationName"], len(codes)) for row in rows]
+            ),
+        )
+        for route, rows in groups.items()
+    }
+
+
+def match_common_routes(routes_place_a, routes_place_b, limit=None, best_per=None):
+    station_codes = {}
+    groups_a = group_by_route(routes_place_a, station_codes)
+    groups_b = group_by_route(routes_place_b, station_codes)
+    common_routes = [route for route in groups_a if route in groups_b]
+
+    route_name_codes = {}
+    pairs = []
+    for k, route in enumerate(common_routes):
+        rows_a, distances_a, codes_a = groups_a[route]
+        rows_b, distances_b, codes_b = groups_b[route]
+        i, j = np.nonzero(codes_a[:, None] != codes_b[None, :])
+        rides = np.full(len(i), np.inf)
+        if station_offsets is not None:
+            rides = route_rides(route, rows_a, rows_b, i, j)
+            valid = ~np.isnan(rides)
+            i, j, rides = i[valid], j[valid], rides[valid]
+        route_name = route_name_codes.setdefault(
+            rows_a[0]["routeName"], len(route_name_codes)
+        )
+        pairs.append(
+            (
+                distances_a[i] + distances_b[j],
+                rides,
+                np.full(len(i), k),
+                np.full(len(i), route_name),
+                i,
+                j,
+                codes_a[i],
+                codes_b[j],
+            )
+        )
+    if not pairs:
+        return []
+
+    totals, rides, route_idx, route_names, idx_a, idx_b, start_codes, end_codes = (
+        np.concatenate(column) for column in zip(*pairs)
+    )
+    if not len(totals):
+        return []
+    scores = totals
+    if station_offsets is not None:
+        scores = ranking_score(totals, rides)
+
+    if best_per is not None:
+        keys = {
+            "route": route_idx,
+            "route_name": route_names,
+            "stations": start_codes * len(station_codes) + end_codes,
+        }[best_per]
+        order = np.argsort(scores, kind="stable")
+        _, first = np.unique(keys[order], return_index=True)
+        selected = order[first]
+    else:
+        selected = np.arange(len(scores))
+
+    if limit is not None and limit < len(selected):
+        best = np.argpartition(scores[selected], limit - 1)[:limit]
+        selected = selected[best]
+    selected = selected[np.argsort(scores[selected], kind="stable")]
 
-    common_routes = routes_a_ids & routes_b_ids
     common_routes_with_stations = []
-    for route in common_routes:
-        stations_a = [r for r in routes_place_a if r["route"] == route]
-        stations_b = [r for r in routes_place_b if r["route"] == route]
-        for station_a in stations_a:
-            for station_b in stations_b:
-                if station_a["stationName"] != station_b["stationName"]:
-                    common_routes_with_stations.append(
-                        {
-                            "route": route,
-                            "route_name": station_a["routeName"],
-                            "start_station": station_a["stationName"],
-                            "start_station_geometry": station_a["stationGeometry"],
-                            "end_station": station_b["stationName"],
-                            "end_station_geometry": station_b["stationGeometry"],
-                            "total_distance": round(
-                                float(station_a["distance"])
-                                + float(station_b["distance"]),
-                                2,
-                            ),
-                            "operator": station_a.get("operator"),
-                        }
-                    )
-
-    return sorted(common_routes_with_stations, key=lambda x: x["total_distance"])
-
-
-def find_routes_with_change(lat1, lon1, lat2, lon2, radius=5):
-    routes_place_a = find_routes_near_point(lon1, lat1, radius)
-    routes_place_b = find_routes_near_point(lon2, lat2, radius)
-
-    routes_a_ids = list(route for route in routes_place_a)
-    routes_b_ids = list(route for route in routes_place_b)
+    for n in selected:
+        route = common_routes[route_idx[n]]
+        station_a = groups_a[route][0][idx_a[n]]
+        station_b = groups_b[route][0][idx_b[n]]
+        common_routes_with_stations.append(
+            {
+                "route": route,
+                "route_name": station_a["routeName"],
+                "start_station": station_a["stationName"],
+                "start_station_geometry": station_a["stationGeometry"],
+                "end_station": station_b["stationName"],
+                "end_station_geometry": station_b["stationGeometry"],
+                "total_distance": round(float(totals[n]), 2),
+                "ride_distance": ride_distance(rides[n]),
+                "operator": station_a.get("operator"),
+            }
+        )
+
+    return common_routes_with_stations
+
+
+def ride_distance(value):
+    return round(float(value), 2) if np.isfinite(value) else None
+
+
+def route_rides(route, rows_a, rows_b, i, j):
+    # along-route distance of each station pair, inf when it is unknown and nan
+    # for pairs on different branches of the route
+    positions_a = station_offsets.positions(route, [row["station"] for row in rows_a])
+    if positions_a is None:
+        return np.full(len(i), np.inf)
+    lines_a, offsets_a = positions_a
+    lines_b, offsets_b = station_offsets.positions(
+        route, [row["station"] for row in rows_b]
+    )
+    return ride_distances(
+        lines_a[i], offsets_a[i], lines_b[j], offsets_b[j], ordered_routes
+    )
+
+
+def change_rides(rows_a, rows_b, intersection):
+    # ride on the first route to the change station plus the ride on the second
+    # route from it, which is only known there by its name, for every pair of a
+    # station near the start and a station near the destination
+    route_a, route_b = intersection["routeA"], intersection["routeB"]
+    rides_a = np.full(len(rows_a), np.inf)
+    rides_b = np.full(len(rows_b), np.inf)
+    positions_a = station_offsets.positions(
+        route_a, [row["station"] for row in rows_a] + [intersection["station1"]]
+    )
+    positions_b = station_offsets.positions(route_b, [row["station"] for row in rows_b])
+    if positions_a is not None:
+        lines, offsets = positions_a
+        rides_a = ride_distances(
+            lines[:-1], offsets[:-1], lines[-1], offsets[-1], ordered_routes
+        )
+    if positions_b is not None:
+        line, offset = station_offsets.position_by_name(
+            route_b, intersection["stationName"]
+        )
+        rides_b = ride_distances(line, offset, *positions_b, ordered_routes)
+    return rides_a[:, None] + rides_b[None, :]
+
+
+@traced
+def find_routes_with_change(lat1, lon1, lat2, lon2, radius=None, limit=15):
+    routes_place_a, routes_place_b = run_concurrently(
+        (find_routes_near_point, lon1, lat1, radius),
+        (find_routes_near_point, lon2, lat2, radius),
+    )
+
+    routes_a_ids = unique_route_ids(routes_place_a)
+    routes_b_ids = unique_route_ids(routes_place_b)
+
+    with connection.routed((lon1, lat1), (lon2, lat2)):
+        transfers = get_transfers(routes_a_ids, routes_b_ids)
+    return match_routes_with_change(routes_place_a, routes_place_b, transfers, limit)
+
+
+def match_routes_with_change(routes_place_a, routes_place_b, transfers, limit=15):
+    if station_offsets is not None:
+        return rank_routes_with_change(routes_place_a, routes_place_b, transfers, limit)
 
     possible_routes_with_change = []
-    for route_a in routes_a_ids:
-        for route_b in routes_b_ids:
-            intersections = get_intersections(route_a["route"], route_b["route"])
-            if len(intersections) > 0:
+    for route_a in routes_place_a:
+        for route_b in routes_place_b:
+            intersection = transfers.get((route_a["route"], route_b["route"]))
+            if intersection is not None:
                 possible_routes_with_change.append(
-                    {
-                        "route_a": route_a["route"],
-                        "route_b": route_b["route"],
-                        "route_name_a": route_a["routeName"],
-                        "route_name_b": route_b["routeName"],
-                        "change": intersections[0]["station1"],
-                        "change_name": intersections[0]["stationName"],
-                        "station_name_a": route_a["stationName"],
-                        "station_name_b": route_b["stationName"],
-                        "station_geometry_a": route_a["stationGeometry"],
-                        "station_geometry_b": route_b["stationGeometry"],
-                    }
+                    route_with_change(route_a, route_b, intersection)
                 )
-                if len(possible_routes_with_change) >= 15:
+                if len(possible_routes_with_change) >= limit:
                     return possible_routes_with_change
 
     return possible_routes_with_change
 
 
+def rank_routes_with_change(routes_place_a, routes_place_b, transfers, limit=15):
+    # the station pairs of each pair of routes are scored at once, ties keep the
+    # order in which the unranked search would have found them
+    rows_a, rows_b = {}, {}
+    for i, row in enumerate(routes_place_a):
+        rows_a.setdefault(row["route"], []).append(i)
+    for j, row in enumerate(routes_place_b):
+        rows_b.setdefault(row["route"], []).append(j)
+    walks_a = np.array([float(row["distance"]) for row in routes_place_a])
+    walks_b = np.array([float(row["distance"]) for row in routes_place_b])
+
+    candidates = []
+    for (route_a, route_b), intersection in transfers.items():
+        if route_a not in rows_a or route_b not in rows_b:
+            continue
+        i = np.array(rows_a[route_a])
+        j = np.array(rows_b[route_b])
+        rides = change_rides(
+            [routes_place_a[k] for k in i], [routes_place_b[k] for k in j], intersection
+        )
+        walks = walks_a[i][:, None] + walks_b[j][None, :]
+        scores = ranking_score(walks, rides)
+        order = i[:, None] * len(routes_place_b) + j[None, :]
+        keep = ~np.isnan(rides)
+        candidates.append((scores[keep], rides[keep], order[keep]))
+    if not candidates:
+        return []
+
+    scores, rides, order = (np.concatenate(column) for column in zip(*candidates))
+    selected = np.arange(len(scores))
+    if limit is not None and limit < len(selected):
+        # candidates tied with the last one kept are sorted too, so that the
+        # earlier found of them wins
+        selected = np.flatnonzero(scores <= np.partition(scores, limit - 1)[limit - 1])
+    selected = selected[np.lexsort((order[selected], scores[selected]))][:limit]
+
+    possible_routes_with_change = []
+    for n in selected:
+        route_a, route_b = divmod(int(order[n]), len(routes_place_b))
+        route_a, route_b = routes_place_a[route_a], routes_place_b[route_b]
+        intersection = transfers[(route_a["route"], route_b["route"])]
+        possible_routes_with_change.append(
+            route_with_change(route_a, route_b, intersection, rides[n])
+        )
+    return possible_routes_with_change
+
+
+def route_with_change(route_a, route_b, intersection, ride=np.inf):
+    return {
+        "route_a": route_a["route"],
+        "route_b": route_b["route"],
+        "route_name_a": route_a["routeName"],
+        "route_name_b": route_b["routeName"],
+        "change": intersection["station1"],
+        "change_name": intersection["stationName"],
+        "station_name_a": route_a["stationName"],
+        "station_name_b": route_b["stationName"],
+        "station_geometry_a": route_a["stationGeometry"],
+        "station_geometry_b": route_b["stationGeometry"],
+        "operator_a": route_a.get("operator"),
+        "operator_b": route_b.get("operator"),
+        "distance_a": float(route_a["distance"]),
+        "distance_b": float(route_b["distance"]),
+        "ride_distance": ride_distance(ride),
+    }
+
+
+@traced_iter
+def iter_common_routes(
+    lat1, lon1, lat2, lon2, radius=None, limit=None, best_per=None, token=None
+):
+    places = dict(
+        iter_completed(
+            [
+                (find_routes_near_point, lon1, lat1, radius),
+                (find_routes_near_point, lon2, lat2, radius),
+            ],
+            token,
+        )
+    )
+    if len(places) < 2:
+        return
+    yield from match_common_routes(places[0], places[1], limit, best_per)
+
+
+@traced_iter
+def iter_routes_with_change(lat1, lon1, lat2, lon2, radius=None, limit=15, token=None):
+    # yields routes with a change as soon as the query that confirms their change
+    # station returns, and stops early when the token fires
+    places = dict(
+        iter_completed(
+            [
+                (find_routes_near_point, lon1, lat1, radius),
+                (find_routes_near_point, lon2, lat2, radius),
+            ],
+            token,
+        )
+    )
+    if len(places) < 2:
+        return
+
+    rows_a, rows_b = {}, {}
+    for row in places[0]:
+        rows_a.setdefault(row["route"], []).append(row)
+    for row in places[1]:
+        rows_b.setdefault(row["route"], []).append(row)
+
+    with connection.routed((lon1, lat1), (lon2, lat2)):
+        transfers, calls = transfer_queries(
+            unique_route_ids(places[0]), unique_route_ids(places[1])
+        )
+        results = itertools.chain(
+            [list(transfers.values())],
+            (rows for _, rows in iter_completed(calls, token)),
+        )
+
+        found, seen = 0, set()
+        for rows in results:
+            for intersection in rows:
+                pair = (intersection["routeA"], intersection["routeB"])
+                if pair in seen:
+                    continue
+                seen.add(pair)
+                if pair[0] not in rows_a or pair[1] not in rows_b:
+                    continue
+                rides = np.full((len(rows_a[pair[0]]), len(rows_b[pair[1]])), np.inf)
+                if station_offsets is not None:
+                    rides = change_rides(rows_a[pair[0]], rows_b[pair[1]], intersection)
+                for i, route_a in enumerate(rows_a[pair[0]]):
+                    for j, route_b in enumerate(rows_b[pair[1]]):
+                        if np.isnan(rides[i, j]):
+                            continue
+                        yield route_with_change(
+                            route_a, route_b, intersection, rides[i, j]
+                        )
+                        found += 1
+                        if found >= limit:
+                            return
+
+
+def unique_route_ids(routes):
+    return list(dict.fromkeys(route["route"] for route in routes))
+
+
+def chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i : i + size]
+
+
+@traced
+def get_transfers(routes_a, routes_b, chunk_size=100):
+    transfers, calls = transfer_queries(routes_a, routes_b, chunk_size)
+    for rows in run_concurrently(*calls):
+        for row in rows:
+            transfers.setdefault((row["routeA"], row["routeB"]), row)
+    return transfers
+
+
+def transfer_queries(routes_a, routes_b, chunk_size=100):
+    transfers = {}
+    groups = [(routes_a, routes_b)]
+    if transfer_table is not None:
+        # routes missing from the precomputed table are still joined by the endpoint
+        known_a = [route for route in routes_a if route in transfer_table]
+        known_b = [route for route in routes_b if route in transfer_table]
+        unknown_a = [route for route in routes_a if route not in transfer_table]
+        unknown_b = [route for route in routes_b if route not in transfer_table]
+        transfers.update(transfer_table.get_transfers(known_a, known_b))
+        groups = [(unknown_a, routes_b), (known_a, unknown_b)]
+
+    calls = [
+        (get_transfers_chunk, chunk_a, chunk_b)
+        for group_a, group_b in groups
+        for chunk_a in chunks(group_a, chunk_size)
+        for chunk_b in chunks(group_b, chunk_size)
+    ]
+    return transfers, calls
+
+
+def get_transfers_chunk(routes_a, routes_b):
+    values_a = " ".join(f"<{route}>" for route in routes_a)
+    values_b = " ".join(f"<{route}>" for route in routes_b)
+    query = f"""
+        SELECT DISTINCT ?routeA ?routeB ?station1 ?stationName WHERE {{
+            VALUES ?routeA {{ {values_a} }}
+            VALUES ?routeB {{ {values_b} }}
+
+            ?routeA ogc:sfContains ?station1 .
+            ?station1 osmkey:name ?stationName .
+
+            ?routeB ogc:sfContains ?station2 .
+            ?station2 osmkey:name ?stationName .
+
+            ?station1 osmkey:railway "stop" .
+        }}
+        ORDER BY ?routeA ?routeB ?stationName ?station1
+    """
+
+    results = connection.query(query, kind="transfers")
+    return results
+
+
+@traced
 def get_intersections(route1, route2):
     query = f"""
         SELECT ?station1 ?stationName WHERE {{
@@ -151,21 +879,23 @@ def get_intersections(route1, route2):
         LIMIT 1
     """
 
-    results = connection.query(query)
+    results = connection.query(query, kind="intersections")
     return results
 
 
+@traced
 def get_route_geometry(route):
     query = f"""
         SELECT ?railGeometry WHERE {{
             <{route}> geo:hasGeometry/geo:asWKT ?railGeometry .
         }}
     """
-    results = connection.query(query)
+    results = connection.query(query, kind="geometry")
 
     return results[0]["railGeometry"]
 
 
+@traced
 def get_unique_routes(routes):
     unique_routes = {}
     for route in routes:
@@ -184,19 +914,122 @@ def get_unique_routes_by_name(routes):
     return list(unique_routes.values())
 
 
+STATION_LABEL_LANGUAGES = ("en", "pl", "de", "da", "cs", "sk", "fr", "nl")
+
+QID_PATTERN = re.compile(r"Q\d+")
+
+station_details_cache = OrderedDict()
+station_details_lock = threading.Lock()
+STATION_DETAILS_CACHE_SIZE = int(os.environ.get("STATION_DETAILS_CACHE_SIZE", "4096"))
+
+
+def literal(value):
+    return json.dumps(value, ensure_ascii=False)
+
+
 def get_station_details(station_name):
-    query = f"""
-        SELECT DISTINCT ?station ?street_address ?coordinate_location ?adjacent_station ?official_website ?date_of_official_opening
-        WHERE {{
-          ?station rdfs:label ?stationLabel;
-            wdt:P31 wd:Q55488.
-          FILTER (CONTAINS(LCASE(?stationLabel), LCASE("{station_name}")))
-          OPTIONAL {{ ?station wdt:P6375 ?street_address. }}
-          OPTIONAL {{ ?station wdt:P625 ?coordinate_location. }}
-          OPTIONAL {{ ?station wdt:P856 ?official_website. }}
-          OPTIONAL {{ ?station wdt:P1619 ?date_of_official_opening. }}
-        }}
-        LIMIT 50
-    """
-    results = wikidata_connection.query(query)
-    return results
+    return get_stations_details([station_name])[station_name]
+
+
+@traced
+def get_stations_details(station_names):
+    details = {}
+    with station_details_lock:
+        for name in dict.fromkeys(station_names):
+            if name in station_details_cache:
+                station_details_cache.move_to_end(name)
+                details[name] = station_details_cache[name]
+    missing = [name for name in dict.fromkeys(station_names) if name not in details]
+    if missing:
+        qids = get_station_qids(missing)
+        unresolved = [name for name in missing if not qids.get(name)]
+        for name, label_qids in get_station_qids_by_label(unresolved).items():
+            qids.setdefault(name, []).extend(label_qids)
+
+        wikidata_details = get_wikidata_details(
+            list(dict.fromkeys(qid for name in missing for qid in qids.get(name, [])))
+        )
+        for name in missing:
+            details[name] = [
+                row
+                for qid in qids.get(name, [])
+                for row in wikidata_details.get(qid, [])
+            ]
+
+        with station_details_lock:
+            for name in missing:
+                station_details_cache[name] = details[name]
+                station_details_cache.move_to_end(name)
+            while len(station_details_cache) > STATION_DETAILS_CACHE_SIZE:
+                station_details_cache.popitem(last=False)
+
+    return {name: details[name] for name in station_names}
+
+
+def parse_qids(value):
+    # OSM wikidata tags may hold several QIDs separated by semicolons, anything
+    # else would break the batched Wikidata query
+    qids = []
+    for qid in value.rsplit("/", 1)[-1].split(";"):
+        qid = qid.strip()
+        if QID_PATTERN.fullmatch(qid):
+            qids.append(qid)
+    return qids
+
+
+def get_station_qids(station_names):
+    qids = {}
+    for chunk in chunks(station_names, 200):
+        values = " ".join(literal(name) for name in chunk)
+        query = f"""
+            SELECT DISTINCT ?stationName ?wikidata WHERE {{
+                VALUES ?stationName {{ {values} }}
+
+                ?station osmkey:name ?stationName ;
+                         osmkey:railway ?railway ;
+                         osmkey:wikidata ?wikidata .
+                FILTER (?railway IN ("station", "halt", "stop"))
+            }}
+        """
+        for row in connection.query(query, kind="station_details"):
+            qids.setdefault(row["stationName"], []).extend(parse_qids(row["wikidata"]))
+    return qids
+
+
+def get_station_qids_by_label(station_names):
+    qids = {}
+    for chunk in chunks(station_names, 50):
+        values = " ".join(
+            f"({literal(name)} {literal(name)}@{language})"
+            for name in chunk
+            for language in STATION_LABEL_LANGUAGES
+        )
+        query = f"""
+            SELECT DISTINCT ?name ?station WHERE {{
+              VALUES (?name ?label) {{ {values} }}
+              ?station rdfs:label ?label;
+                wdt:P31 wd:Q55488.
+            }}
+        """
+        for row in wikidata_connection.query(query, kind="station_details"):
+            qids.setdefault(row["name"], []).append(row["station"].rsplit("/", 1)[-1])
+    return qids
+
+
+def get_wikidata_details(qids):
+    details = {}
+    for chunk in chunks(qids, 200):
+        values = " ".join(f"wd:{qid}" for qid in chunk if QID_PATTERN.fullmatch(qid))
+        query = f"""
+            SELECT DISTINCT ?station ?street_address ?coordinate_location ?adjacent_station ?official_website ?date_of_official_opening
+            WHERE {{
+              VALUES ?station {{ {values} }}
+              OPTIONAL {{ ?station wdt:P6375 ?street_address. }}
+              OPTIONAL {{ ?station wdt:P625 ?coordinate_location. }}
+              OPTIONAL {{ ?station wdt:P856 ?official_website. }}
+              OPTIONAL {{ ?station wdt:P1619 ?date_of_official_opening. }}
+            }}
+        """
+        for row in wikidata_connection.query(query, kind="station_details"):
+            details.setdefault(row["station"].rsplit("/", 1)[-1], []).append(row)
+    return details
@@ -0,0 +1,184 @@
+import functools
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+import logic
+
+
+class PlannerCache:
+    def __init__(self, max_entries=512, ttl=3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.inflight = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.shared = 0
+
+    def get_or_compute(self, key, compute):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+
+            future = self.inflight.get(key)
+            owner = future is None
+            if owner:
+                future = self.inflight[key] = Future()
+                self.misses += 1
+            else:
+                self.shared += 1
+
+        if not owner:
+            return future.result()
+
+        try:
+            value = compute()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                self.inflight.pop(key, None)
+
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        future.set_result(value)
+        return value
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] <= time.monotonic():
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        with self.lock:
+            self.misses += 1
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def discard(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "shared": self.shared,
+                "entries": len(self.entries),
+            }
+
+
+planner_cache = PlannerCache(
+    int(os.environ.get("PLANNER_MEMO_SIZE", "512")),
+    float(os.environ.get("PLANNER_MEMO_TTL", "3600")),
+)
+
+CELL_SIZE = float(os.environ.get("PLANNER_MEMO_CELL", "0.002"))
+
+
+def snap(coordinate, cell=CELL_SIZE):
+    index = round(coordinate / cell)
+    return index, round(index * cell, 6)
+
+
+def copy_result(value):
+    if isinstance(value, list):
+        return [dict(item) if isinstance(item, dict) else item for item in value]
+    return value
+
+
+def snap_points(args, points, cell=CELL_SIZE):
+    cells, snapped = [], []
+    for coordinate in args[: 2 * points]:
+        index, value = snap(coordinate, cell)
+        cells.append(index)
+        snapped.append(value)
+    return tuple(cells), snapped
+
+
+def memoize_points(function, points=2, cache=planner_cache, cell=CELL_SIZE):
+    name = getattr(function, "__qualname__", repr(function))
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        cells, snapped = snap_points(args, points, cell)
+        rest = args[2 * points :]
+        key = (name, cells, rest, tuple(sorted(kwargs.items())))
+        return copy_result(
+            cache.get_or_compute(key, lambda: function(*snapped, *rest, **kwargs))
+        )
+
+    return wrapper
+
+
+def memoize_stream(function, points=2, cache=planner_cache, cell=CELL_SIZE):
+    # complete results are stored and replayed; a stream stopped by its token or
+    # abandoned by the caller is not
+    name = getattr(function, "__qualname__", repr(function))
+
+    @functools.wraps(function)
+    def wrapper(*args, token=None, **kwargs):
+        cells, snapped = snap_points(args, points, cell)
+        rest = args[2 * points :]
+        key = (name, cells, rest, tuple(sorted(kwargs.items())))
+        items = cache.get(key)
+        if items is not None:
+            yield from copy_result(items)
+            return
+
+        items = []
+        for item in function(*snapped, *rest, token=token, **kwargs):
+            items.append(item)
+            yield dict(item)
+        if token is None or not token.cancelled:
+            cache.put(key, items)
+
+    return wrapper
+
+
+def memoize_route(function, cache=planner_cache):
+    name = getattr(function, "__qualname__", repr(function))
+
+    @functools.wraps(function)
+    def wrapper(route, *args):
+        return copy_result(
+            cache.get_or_compute((name, route, args), lambda: function(route, *args))
+        )
+
+    return wrapper
+
+
+find_routes_near_point = memoize_points(logic.find_routes_near_point, points=1)
+find_common_routes = memoize_points(logic.find_common_routes)
+find_routes_with_change = memoize_points(logic.find_routes_with_change)
+iter_common_routes = memoize_stream(logic.iter_common_routes)
+iter_routes_with_change = memoize_stream(logic.iter_routes_with_change)
+get_route_geometry = memoize_route(logic.get_route_geometry)
+
+
+def get_route_geometries(routes):
+    routes = list(dict.fromkeys(routes))
+    futures = [logic.submit(get_route_geometry, route) for route in routes]
+    return {route: future.result() for route, future in zip(routes, futures)}
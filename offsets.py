@@ -0,0 +1,217 @@
+import argparse
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import shapely
+
+from spatial import KM_PER_DEGREE, haversine
+
+MAX_SNAP_KM = 1.0
+
+
+def cumulative_lengths(line):
+    coordinates = shapely.get_coordinates(line)
+    steps = np.diff(coordinates, axis=0)
+    planar = np.concatenate([[0.0], np.cumsum(np.hypot(steps[:, 0], steps[:, 1]))])
+    km = np.concatenate(
+        [
+            [0.0],
+            np.cumsum(
+                haversine(
+                    coordinates[:-1, 0],
+                    coordinates[:-1, 1],
+                    coordinates[1:, 0],
+                    coordinates[1:, 1],
+                )
+            ),
+        ]
+    )
+    return planar, km
+
+
+def project_stations(lines, lons, lats, max_snap=MAX_SNAP_KM):
+    # returns the index of the nearest line of every station (-1 when the station
+    # is further than max_snap from the geometry) and its offset along it in km
+    station_lines = np.full(len(lons), -1, dtype=np.int16)
+    offsets = np.full(len(lons), np.nan, dtype=np.float32)
+    if not lines or not len(lons):
+        return station_lines, offsets
+
+    points = shapely.points(lons, lats)
+    distances = np.stack([shapely.distance(line, points) for line in lines])
+    nearest = np.argmin(distances, axis=0)
+    snapped = distances[nearest, np.arange(len(lons))] * KM_PER_DEGREE <= max_snap
+    for i, line in enumerate(lines):
+        selected = np.flatnonzero((nearest == i) & snapped)
+        if not len(selected):
+            continue
+        planar, km = cumulative_lengths(line)
+        along = shapely.line_locate_point(line, points[selected])
+        station_lines[selected] = i
+        offsets[selected] = np.interp(along, planar, km)
+    return station_lines, offsets
+
+
+class StationOffsets:
+    def __init__(self, route_iris, indptr, station_iris, station_names, lines, offsets):
+        self.route_iris = np.asarray(route_iris, dtype=str)
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.station_iris = np.asarray(station_iris, dtype=str)
+        self.station_names = np.asarray(station_names, dtype=str)
+        self.lines = np.asarray(lines, dtype=np.int16)
+        self.offsets = np.asarray(offsets, dtype=np.float32)
+        self.route_index = {iri: i for i, iri in enumerate(self.route_iris)}
+
+    @classmethod
+    def build(cls, route_members, route_lines, max_snap=MAX_SNAP_KM):
+        # route_members maps a route IRI to (station IRI, name, lon, lat) tuples,
+        # route_lines returns the merged line strings of a route
+        counts, station_iris, station_names, lines, offsets = [], [], [], [], []
+        for iri, members in route_members.items():
+            # stations are sorted by IRI within each route for binary search
+            members = sorted(members)
+            lons = np.array([member[2] for member in members], dtype=float)
+            lats = np.array([member[3] for member in members], dtype=float)
+            route_lines_, route_offsets = project_stations(
+                route_lines(iri), lons, lats, max_snap
+            )
+            counts.append(len(members))
+            station_iris.extend(member[0] for member in members)
+            station_names.extend(member[1] for member in members)
+            lines.append(route_lines_)
+            offsets.append(route_offsets)
+
+        indptr = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=indptr[1:])
+        return cls(
+            list(route_members),
+            indptr,
+            station_iris,
+            station_names,
+            np.concatenate(lines or [np.empty(0, dtype=np.int16)]),
+            np.concatenate(offsets or [np.empty(0, dtype=np.float32)]),
+        )
+
+    @classmethod
+    def from_snapshot(cls, path, route_lines, max_snap=MAX_SNAP_KM):
+        db = sqlite3.connect(path)
+        rows = db.execute("""
+            SELECT routes.iri, stations.iri, stations.name, stations.lon, stations.lat
+            FROM route_stations
+            JOIN routes ON routes.id = route_stations.route_id
+            JOIN stations ON stations.id = route_stations.station_id
+            ORDER BY routes.id
+            """).fetchall()
+        db.close()
+
+        route_members = {}
+        for route, *member in rows:
+            route_members.setdefault(route, []).append(tuple(member))
+        return cls.build(route_members, route_lines, max_snap)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(**{name: data[name] for name in data.files})
+
+    def save(self, path):
+        np.savez_compressed(
+            path,
+            route_iris=self.route_iris,
+            indptr=self.indptr,
+            station_iris=self.station_iris,
+            station_names=self.station_names,
+            lines=self.lines,
+            offsets=self.offsets,
+        )
+
+    def __contains__(self, route):
+        return route in self.route_index
+
+    def positions(self, route, stations):
+        # line index and offset of each station on the route, line -1 for stations
+        # that are not on its geometry; None when the route is not in the table
+        route = self.route_index.get(route)
+        if route is None:
+            return None
+        start, end = self.indptr[route : route + 2]
+        stations = np.asarray(stations, dtype=str)
+        if start == end:
+            return np.full(len(stations), -1), np.full(len(stations), np.nan)
+
+        iris = self.station_iris[start:end]
+        found = np.minimum(np.searchsorted(iris, stations), len(iris) - 1)
+        lines = np.where(iris[found] == stations, self.lines[start:end][found], -1)
+        offsets = np.where(lines >= 0, self.offsets[start:end][found], np.nan)
+        return lines, offsets
+
+    def position_by_name(self, route, name):
+        route = self.route_index.get(route)
+        if route is None:
+            return None
+        start, end = self.indptr[route : route + 2]
+        candidates = np.flatnonzero(
+            (self.station_names[start:end] == name) & (self.lines[start:end] >= 0)
+        )
+        if not len(candidates):
+            return -1, np.nan
+        first = start + candidates[0]
+        return self.lines[first], self.offsets[first]
+
+
+def ride_distances(lines_a, offsets_a, lines_b, offsets_b, ordered=False):
+    # along-route distance between pairs of positions; inf where it is unknown and
+    # nan where the stations lie on different branches or in the wrong order
+    known = (lines_a >= 0) & (lines_b >= 0)
+    rides = np.where(known, np.abs(offsets_b - offsets_a), np.inf)
+    wrong = known & (lines_a != lines_b)
+    if ordered:
+        wrong |= known & (offsets_b < offsets_a)
+    return np.where(wrong, np.nan, rides)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Precompute where the stations of every route lie along its geometry"
+    )
+    parser.add_argument("snapshot", help="SQLite snapshot written by snapshot.py")
+    parser.add_argument("path", help="file to write the offsets to (.npz)")
+    parser.add_argument(
+        "--max-snap",
+        type=float,
+        default=MAX_SNAP_KM,
+        help="kilometres a station may lie away from its route",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=8, help="route geometries fetched at once"
+    )
+    args = parser.parse_args()
+
+    from geometry import load_route_lines
+
+    def route_lines(route):
+        try:
+            return load_route_lines(route)
+        except Exception as e:
+            print(f"{route}: {type(e).__name__}: {e}")
+            return []
+
+    db = sqlite3.connect(args.snapshot)
+    routes = [iri for (iri,) in db.execute("SELECT iri FROM routes")]
+    db.close()
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        lines = dict(zip(routes, executor.map(route_lines, routes)))
+
+    offsets = StationOffsets.from_snapshot(
+        args.snapshot, lambda route: lines.get(route, []), args.max_snap
+    )
+    offsets.save(args.path)
+    print(
+        f"{len(offsets.route_iris)} routes, "
+        f"{int((offsets.lines >= 0).sum())} of {len(offsets.lines)} stations placed"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+import threading
+from concurrent.futures import wait
+
+import logic
+from geometry import load_route_lines
+
+
+class Prefetch:
+    def __init__(
+        self,
+        longitude,
+        latitude,
+        find_routes_near_point=logic.find_routes_near_point,
+        routes=5,
+        radius=None,
+    ):
+        self.point = (longitude, latitude)
+        self.cancelled = threading.Event()
+        self.lock = threading.Lock()
+        self.futures = []
+        with logic.connection.routed(self.point):
+            self.lookup = self.submit(self.run, find_routes_near_point, routes, radius)
+
+    def submit(self, function, *args):
+        with self.lock:
+            if self.cancelled.is_set():
+                return None
+            future = logic.submit(function, *args)
+            self.futures.append(future)
+            return future
+
+    def run(self, find_routes_near_point, routes, radius):
+        # fills the query cache and the geometry store that the search reads
+        # once the second point is selected
+        rows = find_routes_near_point(*self.point, radius)
+        nearest = list(dict.fromkeys(row["route"] for row in rows))[:routes]
+        for route in nearest:
+            self.submit(self.fetch_geometry, route)
+
+    def fetch_geometry(self, route):
+        if not self.cancelled.is_set():
+            load_route_lines(route)
+
+    def cancel(self):
+        with self.lock:
+            self.cancelled.set()
+            for future in self.futures:
+                future.cancel()
+
+    def wait(self, timeout=None):
+        # the search only needs the routes near the point in the query cache, the
+        # geometries keep downloading in the background; errors are left in the
+        # future, the search repeats whatever failed
+        if self.lookup is not None:
+            wait([self.lookup], timeout)
@@ -0,0 +1,96 @@
+import numpy as np
+
+
+def group_csr(rows, columns, size):
+    rows = np.asarray(rows, dtype=np.int64)
+    columns = np.asarray(columns, dtype=np.int64)
+    order = np.lexsort((columns, rows))
+    indptr = np.zeros(size + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=size), out=indptr[1:])
+    return indptr, columns[order]
+
+
+class RouteGraph:
+    def __init__(self, route_stations_indptr, route_stations, station_names):
+        # Stations sharing a name are treated as one stop, the same way
+        # get_intersections matches change stations by osmkey:name.
+        stop_index = {}
+        self.station_stop = np.array(
+            [stop_index.setdefault(name, len(stop_index)) for name in station_names],
+            dtype=np.int64,
+        )
+        self.stop_count = len(stop_index)
+        self.route_count = len(route_stations_indptr) - 1
+
+        route_of_member = np.repeat(
+            np.arange(self.route_count), np.diff(route_stations_indptr)
+        )
+        stops = self.station_stop[route_stations]
+        pairs = np.unique(np.stack([route_of_member, stops], axis=1), axis=0)
+        self.route_stops_indptr, self.route_stops = group_csr(
+            pairs[:, 0], pairs[:, 1], self.route_count
+        )
+        self.stop_routes_indptr, self.stop_routes = group_csr(
+            pairs[:, 1], pairs[:, 0], self.stop_count
+        )
+
+        self.stop_station = np.full(self.stop_count, -1, dtype=np.int64)
+        for station in range(len(station_names) - 1, -1, -1):
+            self.stop_station[self.station_stop[station]] = station
+
+    def stops_of_route(self, route):
+        start, end = self.route_stops_indptr[route : route + 2]
+        return self.route_stops[start:end]
+
+    def routes_of_stop(self, stop):
+        start, end = self.stop_routes_indptr[stop : stop + 2]
+        return self.stop_routes[start:end]
+
+    def search(self, origins, destinations, max_changes=3, limit=15):
+        # origins / destinations map route index -> (walking distance, station index)
+        parent = {route: None for route in origins}
+        frontier = sorted(origins, key=lambda route: origins[route][0])
+        itineraries = []
+
+        for changes in range(max_changes + 1):
+            for route in frontier:
+                if route in destinations:
+                    legs = self.unwind(parent, route)
+                    if not self.useful(legs, origins, destinations):
+                        continue
+                    walk = origins[legs[0][0]][0] + destinations[route][0]
+                    itineraries.append((changes, walk, legs))
+
+            if len(itineraries) >= limit or changes == max_changes:
+                break
+
+            next_frontier = []
+            for route in frontier:
+                for stop in self.stops_of_route(route):
+                    for next_route in self.routes_of_stop(stop):
+                        next_route = int(next_route)
+                        if next_route not in parent:
+                            parent[next_route] = (route, int(stop))
+                            next_frontier.append(next_route)
+            if not next_frontier:
+                break
+            frontier = next_frontier
+
+        itineraries.sort(key=lambda itinerary: (itinerary[0], itinerary[1]))
+        return itineraries[:limit]
+
+    def useful(self, legs, origins, destinations):
+        if len(legs) == 1:
+            return True
+        start_stop = self.station_stop[origins[legs[0][0]][1]]
+        end_stop = self.station_stop[destinations[legs[-1][0]][1]]
+        return legs[0][1] != start_stop and legs[-2][1] != end_stop
+
+    @staticmethod
+    def unwind(parent, route):
+        legs = [(route, None)]
+        while parent[route] is not None:
+            route, stop = parent[route]
+            legs.append((route, stop))
+        legs.reverse()
+        return legs
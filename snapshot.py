@@ -0,0 +1,320 @@
+import argparse
+import re
+import sqlite3
+
+import numpy as np
+
+from logic import (
+    connection,
+    match_common_routes,
+    match_routes_with_change,
+    unique_route_ids,
+    walking_distances,
+)
+from routing import RouteGraph, group_csr
+from spatial import GridIndex
+
+POINT_PATTERN = re.compile(r"POINT\s*\(\s*([-0-9.eE+]+)\s+([-0-9.eE+]+)\s*\)")
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS routes (
+        id INTEGER PRIMARY KEY,
+        iri TEXT UNIQUE NOT NULL,
+        name TEXT NOT NULL,
+        operator TEXT
+    );
+    CREATE TABLE IF NOT EXISTS stations (
+        id INTEGER PRIMARY KEY,
+        iri TEXT UNIQUE NOT NULL,
+        name TEXT NOT NULL,
+        lon REAL NOT NULL,
+        lat REAL NOT NULL,
+        geometry TEXT NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS route_stations (
+        route_id INTEGER NOT NULL REFERENCES routes (id),
+        station_id INTEGER NOT NULL REFERENCES stations (id),
+        PRIMARY KEY (route_id, station_id)
+    );
+"""
+
+
+def parse_point(geometry):
+    match = POINT_PATTERN.search(geometry)
+    if match is None:
+        return None
+    return float(match.group(1)), float(match.group(2))
+
+
+def fetch_route_stations(bbox=None):
+    bbox_filter = ""
+    if bbox is not None:
+        min_lon, min_lat, max_lon, max_lat = bbox
+        bbox_filter = f"""
+            FILTER (geof:longitude(?stationGeometry) >= {min_lon}
+                    && geof:longitude(?stationGeometry) <= {max_lon}
+                    && geof:latitude(?stationGeometry) >= {min_lat}
+                    && geof:latitude(?stationGeometry) <= {max_lat})
+        """
+    query = f"""
+        SELECT ?route ?routeName ?operator ?station ?stationName ?stationGeometry WHERE {{
+            ?route ogc:sfContains ?station ;
+                   osmkey:route ?routeType ;
+                   osmkey:name ?routeName .
+            FILTER (?routeType IN ("train", "railway"))
+            OPTIONAL {{ ?route osmkey:operator ?operator }}
+
+            ?station osmkey:railway "stop" ;
+                     osmkey:name ?stationName ;
+                     geo:hasGeometry/geo:asWKT ?stationGeometry .
+            {bbox_filter}
+        }}
+    """
+
+    results = connection.query(query, kind="snapshot")
+    return results
+
+
+def build_snapshot(path, bbox=None):
+    rows = fetch_route_stations(bbox)
+
+    routes = {}
+    stations = {}
+    memberships = set()
+    for row in rows:
+        point = parse_point(row["stationGeometry"])
+        if point is None:
+            continue
+        route_id = routes.setdefault(
+            row["route"],
+            (len(routes), row["routeName"], row.get("operator")),
+        )[0]
+        station_id = stations.setdefault(
+            row["station"],
+            (len(stations), row["stationName"], *point, row["stationGeometry"]),
+        )[0]
+        memberships.add((route_id, station_id))
+
+    db = sqlite3.connect(path)
+    with db:
+        db.executescript(SCHEMA)
+        db.execute("DELETE FROM route_stations")
+        db.execute("DELETE FROM routes")
+        db.execute("DELETE FROM stations")
+        db.executemany(
+            "INSERT INTO routes VALUES (?, ?, ?, ?)",
+            ((id_, iri, name, op) for iri, (id_, name, op) in routes.items()),
+        )
+        db.executemany(
+            "INSERT INTO stations VALUES (?, ?, ?, ?, ?, ?)",
+            ((values[0], iri, *values[1:]) for iri, values in stations.items()),
+        )
+        db.executemany("INSERT INTO route_stations VALUES (?, ?)", sorted(memberships))
+    db.close()
+
+    return len(routes), len(stations), len(memberships)
+
+
+class SnapshotPlanner:
+    def __init__(self, routes, stations, memberships):
+        self.route_iris = [route[0] for route in routes]
+        self.route_names = [route[1] for route in routes]
+        self.route_operators = [route[2] for route in routes]
+        self.route_index = {iri: i for i, iri in enumerate(self.route_iris)}
+
+        self.station_iris = [station[0] for station in stations]
+        self.station_index = {iri: i for i, iri in enumerate(self.station_iris)}
+        self.station_names = [station[1] for station in stations]
+        self.station_grid = GridIndex(
+            [station[2] for station in stations], [station[3] for station in stations]
+        )
+        self.station_geometries = [station[4] for station in stations]
+
+        memberships = np.asarray(memberships, dtype=np.int64).reshape(-1, 2)
+        self.station_routes_indptr, self.station_routes = group_csr(
+            memberships[:, 1], memberships[:, 0], len(stations)
+        )
+        self.route_stations_indptr, self.route_stations = group_csr(
+            memberships[:, 0], memberships[:, 1], len(routes)
+        )
+        self._route_graph = None
+
+    @classmethod
+    def load(cls, path):
+        db = sqlite3.connect(path)
+        routes = db.execute(
+            "SELECT iri, name, operator FROM routes ORDER BY id"
+        ).fetchall()
+        stations = db.execute(
+            "SELECT iri, name, lon, lat, geometry FROM stations ORDER BY id"
+        ).fetchall()
+        memberships = db.execute(
+            "SELECT route_id, station_id FROM route_stations"
+        ).fetchall()
+        db.close()
+        return cls(routes, stations, memberships)
+
+    def stations_of_route(self, route):
+        start, end = self.route_stations_indptr[route : route + 2]
+        return self.route_stations[start:end]
+
+    def routes_of_station(self, station):
+        start, end = self.station_routes_indptr[station : station + 2]
+        return self.station_routes[start:end]
+
+    def find_routes_near_point(self, longitude, latitude, radius=5):
+        stations, distances = self.station_grid.within(longitude, latitude, radius)
+
+        results = []
+        for station, distance in zip(stations, distances):
+            for route in self.routes_of_station(station):
+                row = {
+                    "route": self.route_iris[route],
+                    "routeName": self.route_names[route],
+                    "stationGeometry": self.station_geometries[station],
+                    "station": self.station_iris[station],
+                    "stationName": self.station_names[station],
+                    "distance": float(distance),
+                }
+                if self.route_operators[route] is not None:
+                    row["operator"] = self.route_operators[route]
+                results.append(row)
+        return walking_distances(longitude, latitude, results)
+
+    def find_common_routes(
+        self, lat1, lon1, lat2, lon2, radius=5, limit=None, best_per=None
+    ):
+        routes_place_a = self.find_routes_near_point(lon1, lat1, radius)
+        routes_place_b = self.find_routes_near_point(lon2, lat2, radius)
+
+        return match_common_routes(routes_place_a, routes_place_b, limit, best_per)
+
+    def find_routes_with_change(self, lat1, lon1, lat2, lon2, radius=5, limit=15):
+        routes_place_a = self.find_routes_near_point(lon1, lat1, radius)
+        routes_place_b = self.find_routes_near_point(lon2, lat2, radius)
+
+        routes_a_ids = unique_route_ids(routes_place_a)
+        routes_b_ids = unique_route_ids(routes_place_b)
+
+        transfers = self.get_transfers(routes_a_ids, routes_b_ids)
+        return match_routes_with_change(
+            routes_place_a, routes_place_b, transfers, limit
+        )
+
+    def get_transfers(self, routes_a, routes_b):
+        stations_by_name_a = {}
+        for route_a in routes_a:
+            by_name = {}
+            for station in self.stations_of_route(self.route_index[route_a]):
+                iri = self.station_iris[station]
+                name = self.station_names[station]
+                if name not in by_name or iri < by_name[name]:
+                    by_name[name] = iri
+            stations_by_name_a[route_a] = by_name
+
+        names_b = {
+            route_b: {
+                self.station_names[station]
+                for station in self.stations_of_route(self.route_index[route_b])
+            }
+            for route_b in routes_b
+        }
+
+        transfers = {}
+        for route_a, by_name in stations_by_name_a.items():
+            for route_b, names in names_b.items():
+                common = by_name.keys() & names
+                if common:
+                    name = min(common)
+                    transfers[(route_a, route_b)] = {
+                        "routeA": route_a,
+                        "routeB": route_b,
+                        "station1": by_name[name],
+                        "stationName": name,
+                    }
+        return transfers
+
+    @property
+    def route_graph(self):
+        if self._route_graph is None:
+            self._route_graph = RouteGraph(
+                self.route_stations_indptr, self.route_stations, self.station_names
+            )
+        return self._route_graph
+
+    def route_access(self, routes_near_point):
+        access = {}
+        for row in routes_near_point:
+            route = self.route_index.get(row["route"])
+            station = self.station_index.get(row["station"])
+            if route is None or station is None:
+                continue
+            distance = float(row["distance"])
+            if route not in access or distance < access[route][0]:
+                access[route] = (distance, station)
+        return access
+
+    def find_routes_with_changes(
+        self, lat1, lon1, lat2, lon2, max_changes=3, radius=5, limit=15
+    ):
+        routes_place_a = self.find_routes_near_point(lon1, lat1, radius)
+        routes_place_b = self.find_routes_near_point(lon2, lat2, radius)
+
+        return self.match_routes_with_changes(
+            routes_place_a, routes_place_b, max_changes, limit
+        )
+
+    def match_routes_with_changes(
+        self, routes_place_a, routes_place_b, max_changes=3, limit=15
+    ):
+        origins = self.route_access(routes_place_a)
+        destinations = self.route_access(routes_place_b)
+
+        graph = self.route_graph
+        itineraries = []
+        for changes, walk, legs in graph.search(
+            origins, destinations, max_changes, limit
+        ):
+            start_station = origins[legs[0][0]][1]
+            end_station = destinations[legs[-1][0]][1]
+            change_stations = [graph.stop_station[stop] for _, stop in legs[:-1]]
+            itineraries.append(
+                {
+                    "routes": [self.route_iris[route] for route, _ in legs],
+                    "route_names": [self.route_names[route] for route, _ in legs],
+                    "changes": [self.station_iris[s] for s in change_stations],
+                    "change_names": [self.station_names[s] for s in change_stations],
+                    "change_geometries": [
+                        self.station_geometries[s] for s in change_stations
+                    ],
+                    "start_station": self.station_names[start_station],
+                    "start_station_geometry": self.station_geometries[start_station],
+                    "end_station": self.station_names[end_station],
+                    "end_station_geometry": self.station_geometries[end_station],
+                    "transfers": changes,
+                    "total_distance": round(walk, 2),
+                }
+            )
+        return itineraries
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Export railway routes and their stations into a local snapshot"
+    )
+    parser.add_argument("path", help="SQLite file to write")
+    parser.add_argument(
+        "--bbox",
+        nargs=4,
+        type=float,
+        metavar=("MIN_LON", "MIN_LAT", "MAX_LON", "MAX_LAT"),
+        help="only export stations inside this bounding box",
+    )
+    args = parser.parse_args()
+
+    routes, stations, memberships = build_snapshot(args.path, args.bbox)
+    print(f"Exported {routes} routes, {stations} stations, {memberships} memberships")
+
+
+if __name__ == "__main__":
+    main()
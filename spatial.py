@@ -0,0 +1,107 @@
+import math
+import sqlite3
+
+import numpy as np
+
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+
+
+def haversine(lon, lat, lons, lats):
+    lon, lat = np.radians(lon), np.radians(lat)
+    lons, lats = np.radians(lons), np.radians(lats)
+    a = (
+        np.sin((lats - lat) / 2) ** 2
+        + np.cos(lat) * np.cos(lats) * np.sin((lons - lon) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+
+
+class GridIndex:
+    def __init__(self, lons, lats, cell_size=0.05):
+        self.lons = np.asarray(lons, dtype=np.float64)
+        self.lats = np.asarray(lats, dtype=np.float64)
+        self.cell_size = cell_size
+        self.columns = math.ceil(360 / cell_size)
+
+        cells = self.cell(self.lons, self.lats)
+        self.order = np.argsort(cells, kind="stable")
+        self.cells, self.starts = np.unique(cells[self.order], return_index=True)
+        self.ends = np.append(self.starts[1:], len(self.order))
+
+    def cell(self, lons, lats):
+        x = np.floor((np.asarray(lons) + 180) / self.cell_size).astype(np.int64)
+        x %= self.columns
+        y = np.floor((np.asarray(lats) + 90) / self.cell_size).astype(np.int64)
+        return y * self.columns + x
+
+    def candidates(self, longitude, latitude, radius):
+        dlat = radius / KM_PER_DEGREE
+        cos_lat = max(math.cos(math.radians(latitude)), 1e-6)
+        dlon = min(radius / (KM_PER_DEGREE * cos_lat), 180)
+
+        x0, y0 = np.floor(
+            (np.array([longitude - dlon, latitude - dlat]) + [180, 90]) / self.cell_size
+        ).astype(np.int64)
+        x1, y1 = np.floor(
+            (np.array([longitude + dlon, latitude + dlat]) + [180, 90]) / self.cell_size
+        ).astype(np.int64)
+        xs = np.arange(x0, x1 + 1) % self.columns
+        ys = np.arange(max(y0, 0), y1 + 1)
+        wanted = (ys[:, None] * self.columns + xs[None, :]).ravel()
+
+        wanted = np.unique(wanted)
+        positions = np.searchsorted(self.cells, wanted)
+        found = positions < len(self.cells)
+        positions, wanted = positions[found], wanted[found]
+        positions = positions[self.cells[positions] == wanted]
+        if len(positions) == 0:
+            return np.empty(0, dtype=np.int64)
+        return np.concatenate(
+            [self.order[self.starts[p] : self.ends[p]] for p in positions]
+        )
+
+    def within(self, longitude, latitude, radius):
+        candidates = self.candidates(longitude, latitude, radius)
+        distances = haversine(
+            longitude, latitude, self.lons[candidates], self.lats[candidates]
+        )
+        mask = distances <= radius
+        candidates, distances = candidates[mask], distances[mask]
+        order = np.argsort(distances, kind="stable")
+        return candidates[order], distances[order]
+
+
+class StationIndex:
+    def __init__(self, iris, names, lons, lats, geometries, cell_size=0.05):
+        self.iris = iris
+        self.names = names
+        self.geometries = geometries
+        self.grid = GridIndex(lons, lats, cell_size)
+
+    @classmethod
+    def load(cls, path):
+        db = sqlite3.connect(path)
+        stations = db.execute(
+            "SELECT iri, name, lon, lat, geometry FROM stations ORDER BY id"
+        ).fetchall()
+        db.close()
+        return cls(
+            [station[0] for station in stations],
+            [station[1] for station in stations],
+            [station[2] for station in stations],
+            [station[3] for station in stations],
+            [station[4] for station in stations],
+        )
+
+    def within(self, longitude, latitude, radius):
+        stations, distances = self.grid.within(longitude, latitude, radius)
+        return [
+            {
+                "station": self.iris[station],
+                "stationName": self.names[station],
+                "stationGeometry": self.geometries[station],
+                "distance": float(distance),
+            }
+            for station, distance in zip(stations, distances)
+        ]
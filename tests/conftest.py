@@ -0,0 +1,7 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# the planner modules open the on-disk query cache when they are imported
+os.environ.setdefault("SPARQL_CACHE", "0")
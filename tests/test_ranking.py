@@ -0,0 +1,196 @@
+import random
+
+import numpy as np
+import pytest
+
+import logic
+from offsets import StationOffsets, ride_distances
+
+
+def station_offsets(routes):
+    # routes maps a route IRI to (station IRI, name, line, offset) tuples
+    route_iris, indptr, columns = [], [0], []
+    for route, stations in routes.items():
+        route_iris.append(route)
+        columns.extend(sorted(stations))
+        indptr.append(len(columns))
+    iris, names, lines, offsets = zip(*columns)
+    return StationOffsets(route_iris, indptr, iris, names, lines, offsets)
+
+
+def row(route, station, distance):
+    return {
+        "route": route,
+        "routeName": route.upper(),
+        "station": station,
+        "stationName": station.upper(),
+        "stationGeometry": "POINT (0 0)",
+        "distance": distance,
+    }
+
+
+def transfer(route_a, route_b, station):
+    return {
+        "routeA": route_a,
+        "routeB": route_b,
+        "station1": station,
+        "stationName": station.upper(),
+    }
+
+
+@pytest.fixture
+def offsets(monkeypatch):
+    table = station_offsets(
+        {
+            "a": [("a1", "A1", 0, 0.0), ("a2", "A2", 0, 4.0), ("x", "X", 0, 10.0)],
+            "b": [("b1", "B1", 0, 1.0), ("b2", "B2", 1, 3.0), ("x", "X", 0, 5.0)],
+            "c": [("c1", "C1", 0, 0.0), ("y", "Y", 0, 2.0)],
+        }
+    )
+    monkeypatch.setattr(logic, "station_offsets", table)
+    monkeypatch.setattr(logic, "ordered_routes", False)
+    return table
+
+
+def test_ranks_by_walk_plus_ride(offsets):
+    routes_place_a = [row("a", "a1", 0.1), row("a", "a2", 0.5)]
+    routes_place_b = [row("b", "b1", 0.2)]
+    transfers = {("a", "b"): transfer("a", "b", "x")}
+
+    ranked = logic.rank_routes_with_change(routes_place_a, routes_place_b, transfers)
+
+    # a2 is walked to further but the ride from it is 4 km shorter
+    assert [route["station_name_a"] for route in ranked] == ["A2", "A1"]
+    assert [route["ride_distance"] for route in ranked] == [10.0, 14.0]
+
+
+def test_drops_stations_on_other_branches(offsets):
+    routes_place_a = [row("a", "a1", 0.1)]
+    routes_place_b = [row("b", "b1", 0.2), row("b", "b2", 0.1)]
+    transfers = {("a", "b"): transfer("a", "b", "x")}
+
+    ranked = logic.rank_routes_with_change(routes_place_a, routes_place_b, transfers)
+
+    assert [route["station_name_b"] for route in ranked] == ["B1"]
+
+
+def test_unknown_rides_rank_after_known_ones(offsets):
+    routes_place_a = [row("d", "d1", 0.0), row("a", "a1", 3.0)]
+    routes_place_b = [row("b", "b1", 0.0)]
+    transfers = {
+        ("d", "b"): transfer("d", "b", "x"),
+        ("a", "b"): transfer("a", "b", "x"),
+    }
+
+    ranked = logic.rank_routes_with_change(routes_place_a, routes_place_b, transfers)
+
+    assert [route["route_a"] for route in ranked] == ["a", "d"]
+    assert ranked[1]["ride_distance"] is None
+
+
+def test_ties_keep_the_order_of_the_search(offsets):
+    routes_place_a = [row("c", "c1", 1.0), row("a", "a1", 1.0)]
+    routes_place_b = [row("c", "c1", 1.0), row("b", "b1", 1.0)]
+    transfers = {
+        ("a", "b"): transfer("a", "b", "q"),
+        ("c", "c"): transfer("c", "c", "q"),
+    }
+
+    ranked = logic.rank_routes_with_change(
+        routes_place_a, routes_place_b, transfers, limit=1
+    )
+
+    # both rides are unknown, so the pair the search finds first wins
+    assert [(route["route_a"], route["route_b"]) for route in ranked] == [("c", "c")]
+
+
+def reference_ride(table, route_a, route_b, intersection, ordered):
+    ride = 0.0
+    positions_a = table.positions(
+        route_a["route"], [route_a["station"], intersection["station1"]]
+    )
+    positions_b = table.positions(route_b["route"], [route_b["station"]])
+    if positions_a is None or positions_b is None:
+        ride += np.inf
+    if positions_a is not None:
+        lines, offsets = positions_a
+        ride += ride_distances(lines[:1], offsets[:1], lines[1:], offsets[1:], ordered)[
+            0
+        ]
+    if positions_b is not None:
+        line, offset = table.position_by_name(
+            route_b["route"], intersection["stationName"]
+        )
+        ride += ride_distances(
+            np.array([line]), np.array([offset]), *positions_b, ordered
+        )[0]
+    return ride
+
+
+def reference_ranking(routes_place_a, routes_place_b, transfers, limit):
+    # every station pair on its own, in the order of the unranked search
+    candidates = []
+    for route_a in routes_place_a:
+        for route_b in routes_place_b:
+            intersection = transfers.get((route_a["route"], route_b["route"]))
+            if intersection is None:
+                continue
+            ride = reference_ride(
+                logic.station_offsets,
+                route_a,
+                route_b,
+                intersection,
+                logic.ordered_routes,
+            )
+            if np.isnan(ride):
+                continue
+            walk = route_a["distance"] + route_b["distance"]
+            score = float(logic.ranking_score(walk, ride))
+            candidates.append((score, len(candidates), route_a, route_b, ride))
+    candidates.sort(key=lambda candidate: candidate[:2])
+    return [
+        logic.route_with_change(
+            route_a,
+            route_b,
+            transfers[(route_a["route"], route_b["route"])],
+            ride,
+        )
+        for _, _, route_a, route_b, ride in candidates[:limit]
+    ]
+
+
+@pytest.mark.parametrize("ordered", [False, True])
+def test_matches_ranking_each_station_pair(monkeypatch, ordered):
+    rng = random.Random(3)
+    stations = [f"s{i:02d}" for i in range(30)]
+    routes = [f"r{i}" for i in range(8)]
+    table = station_offsets(
+        {
+            route: [
+                (station, station.upper(), rng.choice([-1, 0, 1]), rng.uniform(0, 20))
+                for station in rng.sample(stations, 10)
+            ]
+            for route in routes[:6]
+        }
+    )
+    monkeypatch.setattr(logic, "station_offsets", table)
+    monkeypatch.setattr(logic, "ordered_routes", ordered)
+
+    def place():
+        return [
+            row(rng.choice(routes), rng.choice(stations), rng.randint(0, 20) / 10)
+            for _ in range(20)
+        ]
+
+    for _ in range(10):
+        routes_place_a, routes_place_b = place(), place()
+        transfers = {
+            (route_a, route_b): transfer(route_a, route_b, rng.choice(stations))
+            for route_a in routes
+            for route_b in routes
+            if rng.random() < 0.5
+        }
+        for limit in (3, 15, 1000):
+            assert logic.rank_routes_with_change(
+                routes_place_a, routes_place_b, transfers, limit
+            ) == reference_ranking(routes_place_a, routes_place_b, transfers, limit)
@@ -0,0 +1,104 @@
+import random
+
+import pytest
+
+from transfers import TransferTable
+
+
+def expected_transfers(route_members):
+    # what the endpoint query returns: every ordered pair of routes sharing a
+    # station name, a route paired with itself included, changing at the first
+    # shared name and the first station with that name on the first route
+    transfers = {}
+    for route_a, stations_a in route_members.items():
+        by_name = {}
+        for iri, name in stations_a:
+            by_name[name] = min(by_name.get(name, iri), iri)
+        for route_b, stations_b in route_members.items():
+            common = by_name.keys() & {name for _, name in stations_b}
+            if common:
+                name = min(common)
+                transfers[(route_a, route_b)] = {
+                    "routeA": route_a,
+                    "routeB": route_b,
+                    "station1": by_name[name],
+                    "stationName": name,
+                }
+    return transfers
+
+
+def random_members(rng, stations, routes):
+    return {
+        route: rng.sample(stations, rng.randint(0, 8))
+        for route in (f"http://route/{i}" for i in range(routes))
+    }
+
+
+@pytest.fixture
+def stations():
+    return [(f"http://station/{i:03d}", f"Station {i % 30}") for i in range(80)]
+
+
+def test_from_members_matches_endpoint(stations):
+    members = random_members(random.Random(1), stations, 40)
+    table = TransferTable.from_members(members)
+    routes = list(members)
+    assert table.get_transfers(routes, routes) == expected_transfers(members)
+
+
+def test_route_alone_at_its_stops_pairs_with_itself():
+    members = {
+        "http://route/a": [("http://station/1", "Alone")],
+        "http://route/b": [],
+    }
+    table = TransferTable.from_members(members)
+    assert table.get_transfers(list(members), list(members)) == {
+        ("http://route/a", "http://route/a"): {
+            "routeA": "http://route/a",
+            "routeB": "http://route/a",
+            "station1": "http://station/1",
+            "stationName": "Alone",
+        }
+    }
+
+
+def test_refresh_matches_rebuilt_table(stations):
+    rng = random.Random(2)
+    members = random_members(rng, stations, 40)
+    table = TransferTable.from_members(members)
+    for step in range(5):
+        changes = {
+            route: rng.sample(stations, rng.randint(0, 8))
+            for route in rng.sample(list(members), 4)
+        }
+        changes[rng.choice(list(members))] = None
+        changes[f"http://route/new{step}"] = rng.sample(stations, 5)
+        table.refresh(changes)
+        members.update({route: stations or [] for route, stations in changes.items()})
+
+        routes = list(members)
+        assert table.get_transfers(routes, routes) == expected_transfers(members)
+
+
+def test_refresh_applies_station_renames():
+    members = {
+        "http://route/a": [("http://station/1", "A"), ("http://station/2", "M")],
+        "http://route/b": [("http://station/1", "A"), ("http://station/2", "M")],
+        "http://route/c": [("http://station/3", "Other")],
+    }
+    table = TransferTable.from_members(members)
+
+    # after the rename the first shared name is the other station's
+    renamed = [("http://station/1", "Z"), ("http://station/2", "M")]
+    table.refresh({"http://route/a": renamed})
+    members["http://route/a"] = members["http://route/b"] = renamed
+
+    routes = list(members)
+    transfers = table.get_transfers(routes, routes)
+    assert transfers == expected_transfers(members)
+    assert transfers[("http://route/b", "http://route/b")] == {
+        "routeA": "http://route/b",
+        "routeB": "http://route/b",
+        "station1": "http://station/2",
+        "stationName": "M",
+    }
@@ -0,0 +1,136 @@
+import json
+import re
+import threading
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import shapely
+
+from geometry import geometry_store
+
+try:
+    import mapbox_vector_tile
+except ImportError:
+    mapbox_vector_tile = None
+
+EARTH_RADIUS_M = 6378137.0
+ORIGIN_SHIFT = np.pi * EARTH_RADIUS_M
+MAX_LATITUDE = 85.0511287798
+
+TILE_PATH = re.compile(r"^/(\w+)/(\d+)/(\d+)/(\d+)\.pbf$")
+
+
+def mercator(coordinates):
+    latitudes = np.radians(np.clip(coordinates[:, 0], -MAX_LATITUDE, MAX_LATITUDE))
+    x = np.radians(coordinates[:, 1]) * EARTH_RADIUS_M
+    y = np.log(np.tan(np.pi / 4 + latitudes / 2)) * EARTH_RADIUS_M
+    return np.column_stack([x, y])
+
+
+def tile_bounds(z, x, y):
+    size = 2 * ORIGIN_SHIFT / 2**z
+    min_x = -ORIGIN_SHIFT + x * size
+    max_y = ORIGIN_SHIFT - y * size
+    return min_x, max_y - size, min_x + size, max_y
+
+
+class TileServer:
+    def __init__(self, max_layers=256, extent=4096, buffer=8):
+        if mapbox_vector_tile is None:
+            raise RuntimeError("vector tiles require the mapbox_vector_tile package")
+        self.max_layers = max_layers
+        self.extent = extent
+        self.buffer = buffer
+        self.layers = OrderedDict()
+        self.lock = threading.Lock()
+
+    def register(self, segments):
+        # segments are (geometry store key, properties) pairs, the "color" property
+        # names the tile layer the feature is drawn in
+        layer_id = geometry_store.key(
+            *(
+                f"{key}:{json.dumps(properties, sort_keys=True)}"
+                for key, properties in segments
+            )
+        )
+        with self.lock:
+            if layer_id in self.layers:
+                self.layers.move_to_end(layer_id)
+                return layer_id
+
+        features = []
+        for key, properties in segments:
+            lines = [
+                shapely.linestrings(mercator(np.asarray(line)))
+                for line in geometry_store.lines(key)
+                if len(line) > 1
+            ]
+            if lines:
+                features.append((properties, shapely.multilinestrings(lines)))
+
+        with self.lock:
+            self.layers[layer_id] = features
+            while len(self.layers) > self.max_layers:
+                self.layers.popitem(last=False)
+        return layer_id
+
+    def tile(self, layer_id, z, x, y):
+        with self.lock:
+            features = self.layers.get(layer_id)
+        if features is None:
+            return None
+
+        bounds = tile_bounds(z, x, y)
+        pixel = (bounds[2] - bounds[0]) / 256
+        margin = self.buffer * pixel
+        layers = {}
+        for properties, geometry in features:
+            clipped = shapely.clip_by_rect(
+                geometry,
+                bounds[0] - margin,
+                bounds[1] - margin,
+                bounds[2] + margin,
+                bounds[3] + margin,
+            )
+            if clipped.is_empty:
+                continue
+            clipped = clipped.simplify(pixel / 2, preserve_topology=False)
+            layers.setdefault(properties["color"], []).append(
+                {"geometry": clipped, "properties": properties}
+            )
+
+        return mapbox_vector_tile.encode(
+            [{"name": name, "features": items} for name, items in layers.items()],
+            default_options={"quantize_bounds": bounds, "extents": self.extent},
+        )
+
+    def serve(self, port):
+        tiles = self
+
+        class TileHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                match = TILE_PATH.match(self.path)
+                body = None
+                if match:
+                    layer_id, z, x, y = match.groups()
+                    body = tiles.tile(layer_id, int(z), int(x), int(y))
+                if body is None:
+                    self.send_response(404)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", "application/x-protobuf")
+                self.send_header("Content-Length", str(len(body)))
+                self.send_header("Access-Control-Allow-Origin", "*")
+                self.send_header("Cache-Control", "max-age=3600")
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer(("0.0.0.0", port), TileHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
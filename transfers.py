@@ -0,0 +1,308 @@
+import argparse
+import sqlite3
+
+import numpy as np
+
+from routing import group_csr
+
+
+class TransferTable:
+    def __init__(
+        self,
+        route_iris,
+        station_iris,
+        station_names,
+        members_indptr,
+        members,
+        transfers_indptr=None,
+        transfer_routes=None,
+        transfer_stations=None,
+    ):
+        self.route_iris = np.asarray(route_iris, dtype=str)
+        self.station_iris = np.asarray(station_iris, dtype=str)
+        self.station_names = np.asarray(station_names, dtype=str)
+        self.members_indptr = np.asarray(members_indptr, dtype=np.int64)
+        self.members = np.asarray(members, dtype=np.int64)
+        self.route_index = {iri: i for i, iri in enumerate(self.route_iris)}
+        self.station_index = {iri: i for i, iri in enumerate(self.station_iris)}
+
+        if transfers_indptr is None:
+            rows, columns, stations = self.compute_pairs()
+            self.set_transfers(rows, columns, stations)
+        else:
+            self.transfers_indptr = np.asarray(transfers_indptr, dtype=np.int64)
+            self.transfer_routes = np.asarray(transfer_routes, dtype=np.int64)
+            self.transfer_stations = np.asarray(transfer_stations, dtype=np.int64)
+
+    @classmethod
+    def from_members(cls, route_members):
+        route_iris = list(route_members)
+        station_iris, station_names, station_index = [], [], {}
+        rows, columns = [], []
+        for route, stations in enumerate(route_members.values()):
+            for iri, name in stations:
+                if iri not in station_index:
+                    station_index[iri] = len(station_iris)
+                    station_iris.append(iri)
+                    station_names.append(name)
+                rows.append(route)
+                columns.append(station_index[iri])
+        indptr, members = group_csr(rows, columns, len(route_iris))
+        return cls(route_iris, station_iris, station_names, indptr, members)
+
+    @classmethod
+    def from_snapshot(cls, path):
+        db = sqlite3.connect(path)
+        rows = db.execute("""
+            SELECT routes.iri, stations.iri, stations.name
+            FROM route_stations
+            JOIN routes ON routes.id = route_stations.route_id
+            JOIN stations ON stations.id = route_stations.station_id
+            ORDER BY routes.id
+            """).fetchall()
+        db.close()
+
+        route_members = {}
+        for route, station, name in rows:
+            route_members.setdefault(route, []).append((station, name))
+        return cls.from_members(route_members)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(**{name: data[name] for name in data.files})
+
+    def save(self, path):
+        np.savez_compressed(
+            path,
+            route_iris=self.route_iris,
+            station_iris=self.station_iris,
+            station_names=self.station_names,
+            members_indptr=self.members_indptr,
+            members=self.members,
+            transfers_indptr=self.transfers_indptr,
+            transfer_routes=self.transfer_routes,
+            transfer_stations=self.transfer_stations,
+        )
+
+    def __contains__(self, route):
+        return route in self.route_index
+
+    def compute_pairs(self, routes=None):
+        route_count = len(self.route_iris)
+        member_routes = np.repeat(np.arange(route_count), np.diff(self.members_indptr))
+        # stops are station names in sorted order, so the smallest stop code of a
+        # route pair is the alphabetically first change station
+        _, stops = np.unique(self.station_names, return_inverse=True)
+        station_rank = np.argsort(np.argsort(self.station_iris, kind="stable"))
+        member_stops = stops[self.members]
+
+        order = np.lexsort((station_rank[self.members], member_stops, member_routes))
+        member_routes = member_routes[order]
+        member_stops = member_stops[order]
+        member_stations = self.members[order]
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = (member_routes[1:] != member_routes[:-1]) | (
+            member_stops[1:] != member_stops[:-1]
+        )
+        member_routes = member_routes[first]
+        member_stops = member_stops[first]
+        member_stations = member_stations[first]
+
+        selected = None
+        if routes is not None:
+            selected = np.zeros(route_count, dtype=bool)
+            selected[list(routes)] = True
+
+        by_stop = np.argsort(member_stops, kind="stable")
+        boundaries = np.flatnonzero(np.diff(member_stops[by_stop])) + 1
+        pairs = []
+        for group in np.split(by_stop, boundaries):
+            if not len(group):
+                continue
+            group_routes = member_routes[group]
+            if selected is not None and not selected[group_routes].any():
+                continue
+            n = len(group)
+            a = np.repeat(group_routes, n)
+            b = np.tile(group_routes, n)
+            # a route paired with itself is kept, as the endpoint query returns it
+            keep = np.ones(len(a), dtype=bool)
+            if selected is not None:
+                keep &= selected[a] | selected[b]
+            pairs.append(
+                (
+                    a[keep],
+                    b[keep],
+                    np.repeat(member_stops[group], n)[keep],
+                    np.repeat(member_stations[group], n)[keep],
+                )
+            )
+
+        if not pairs:
+            empty = np.empty(0, dtype=np.int64)
+            return empty, empty, empty
+        a, b, stop, station = (np.concatenate(column) for column in zip(*pairs))
+        order = np.lexsort((stop, b, a))
+        a, b, station = a[order], b[order], station[order]
+        first = np.ones(len(a), dtype=bool)
+        first[1:] = (a[1:] != a[:-1]) | (b[1:] != b[:-1])
+        return a[first], b[first], station[first]
+
+    def set_transfers(self, rows, columns, stations):
+        order = np.lexsort((columns, rows))
+        self.transfers_indptr = np.zeros(len(self.route_iris) + 1, dtype=np.int64)
+        np.cumsum(
+            np.bincount(rows, minlength=len(self.route_iris)),
+            out=self.transfers_indptr[1:],
+        )
+        self.transfer_routes = np.asarray(columns, dtype=np.int64)[order]
+        self.transfer_stations = np.asarray(stations, dtype=np.int64)[order]
+
+    def transfers_of(self, route):
+        start, end = self.transfers_indptr[route : route + 2]
+        return self.transfer_routes[start:end], self.transfer_stations[start:end]
+
+    def get_transfers(self, routes_a, routes_b):
+        routes_b = {self.route_index[route]: route for route in routes_b}
+        transfers = {}
+        for route_a in routes_a:
+            partners, stations = self.transfers_of(self.route_index[route_a])
+            for partner, station in zip(partners, stations):
+                route_b = routes_b.get(int(partner))
+                if route_b is not None:
+                    transfers[(route_a, route_b)] = {
+                        "routeA": route_a,
+                        "routeB": route_b,
+                        "station1": str(self.station_iris[station]),
+                        "stationName": str(self.station_names[station]),
+                    }
+        return transfers
+
+    def refresh(self, route_members):
+        # route_members maps a route IRI to its (station IRI, name) pairs, or to
+        # None when the relation was removed
+        station_iris = list(self.station_iris)
+        station_names = list(self.station_names)
+        route_iris = list(self.route_iris)
+        members = {
+            route: self.members[
+                self.members_indptr[route] : self.members_indptr[route + 1]
+            ]
+            for route in range(len(route_iris))
+        }
+
+        changed, renamed = set(), set()
+        for iri, stations in route_members.items():
+            if iri not in self.route_index:
+                self.route_index[iri] = len(route_iris)
+                route_iris.append(iri)
+            route = self.route_index[iri]
+            changed.add(route)
+            indices = []
+            for station_iri, name in stations or []:
+                if station_iri not in self.station_index:
+                    self.station_index[station_iri] = len(station_iris)
+                    station_iris.append(station_iri)
+                    station_names.append(name)
+                station = self.station_index[station_iri]
+                if station_names[station] != name:
+                    station_names[station] = name
+                    renamed.add(station)
+                indices.append(station)
+            members[route] = np.asarray(indices, dtype=np.int64)
+
+        # change stations are matched by name, so the pairs of every route that
+        # stops at a renamed station are computed again
+        if renamed:
+            renamed = np.asarray(list(renamed), dtype=np.int64)
+            changed.update(
+                route
+                for route in range(len(route_iris))
+                if np.isin(members[route], renamed).any()
+            )
+
+        rows = np.repeat(
+            np.arange(len(route_iris)),
+            [len(members[route]) for route in range(len(route_iris))],
+        )
+        columns = np.concatenate(
+            [members[route] for route in range(len(route_iris))]
+            or [np.empty(0, dtype=np.int64)]
+        )
+
+        old_rows = np.repeat(
+            np.arange(len(self.route_iris)), np.diff(self.transfers_indptr)
+        )
+        old_columns = self.transfer_routes
+        old_stations = self.transfer_stations
+
+        self.route_iris = np.asarray(route_iris, dtype=str)
+        self.station_iris = np.asarray(station_iris, dtype=str)
+        self.station_names = np.asarray(station_names, dtype=str)
+        self.members_indptr, self.members = group_csr(rows, columns, len(route_iris))
+
+        unchanged = ~(
+            np.isin(old_rows, list(changed)) | np.isin(old_columns, list(changed))
+        )
+        new_rows, new_columns, new_stations = self.compute_pairs(changed)
+        self.set_transfers(
+            np.concatenate([old_rows[unchanged], new_rows]),
+            np.concatenate([old_columns[unchanged], new_columns]),
+            np.concatenate([old_stations[unchanged], new_stations]),
+        )
+        return len(changed)
+
+
+def fetch_route_members(connection, routes):
+    route_members = {route: None for route in routes}
+    values = " ".join(f"<{route}>" for route in routes)
+    query = f"""
+        SELECT ?route ?station ?stationName WHERE {{
+            VALUES ?route {{ {values} }}
+            ?route ogc:sfContains ?station .
+            ?station osmkey:railway "stop" ;
+                     osmkey:name ?stationName .
+        }}
+    """
+    for row in connection.query(query, kind="transfers"):
+        if route_members[row["route"]] is None:
+            route_members[row["route"]] = []
+        route_members[row["route"]].append((row["station"], row["stationName"]))
+    return route_members
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Precompute the stations where pairs of railway routes meet"
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    build = commands.add_parser("build", help="build the table from a snapshot")
+    build.add_argument("snapshot", help="SQLite snapshot written by snapshot.py")
+    build.add_argument("path", help="file to write the table to (.npz)")
+
+    refresh = commands.add_parser(
+        "refresh", help="update the table for relations that changed in OSM"
+    )
+    refresh.add_argument("path", help="table written by the build command")
+    refresh.add_argument("routes", nargs="+", help="IRIs of the changed relations")
+
+    args = parser.parse_args()
+
+    if args.command == "build":
+        table = TransferTable.from_snapshot(args.snapshot)
+    else:
+        from logic import connection
+
+        table = TransferTable.load(args.path)
+        table.refresh(fetch_route_members(connection, args.routes))
+    table.save(args.path)
+    print(
+        f"{len(table.route_iris)} routes, "
+        f"{len(table.transfer_routes)} route pairs with a change station"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+import re
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+ACCEPT = {
+    "json": "application/sparql-results+json",
+    "tsv": "text/tab-separated-values",
+    "qlever": "application/qlever-results+json",
+}
+
+ESCAPE_PATTERN = re.compile(r"\\(?:u([0-9A-Fa-f]{4})|U([0-9A-Fa-f]{8})|(.))")
+ESCAPES = {"t": "\t", "n": "\n", "r": "\r", "b": "\b", "f": "\f"}
+
+
+def unescape(value):
+    def replace(match):
+        code = match.group(1) or match.group(2)
+        if code:
+            return chr(int(code, 16))
+        return ESCAPES.get(match.group(3), match.group(3))
+
+    return ESCAPE_PATTERN.sub(replace, value)
+
+
+def decode_term(term):
+    if term.startswith("<") and term.endswith(">"):
+        return term[1:-1]
+    if term.startswith('"'):
+        end = term.rindex('"')
+        return unescape(term[1:end])
+    return term
+
+
+class RateLimiter:
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.lock = threading.Lock()
+        self.next_time = time.monotonic()
+
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            wait = self.next_time - now
+            self.next_time = max(self.next_time, now) + self.interval
+        if wait > 0:
+            time.sleep(wait)
+
+
+class SparqlTransport:
+    def __init__(
+        self, endpoint, result_format="json", timeout=60, pool_size=4, rate_limiter=None
+    ):
+        self.endpoint = endpoint
+        self.result_format = result_format
+        self.timeout = timeout
+        self.rate_limiter = rate_limiter
+        self.session = requests.Session()
+        self.session.headers.update(
+            {
+                "Accept": ACCEPT[result_format],
+                "Accept-Encoding": "gzip, deflate",
+                "User-Agent": "RailwayJourneyPlanner/1.0 (python-requests)",
+            }
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def rows(self, query, stats=None):
+        stats = {} if stats is None else stats
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire()
+        response = self.session.post(
+            self.endpoint,
+            data={"query": query},
+            timeout=self.timeout,
+            stream=self.result_format == "tsv",
+        )
+        try:
+            response.raise_for_status()
+        except requests.HTTPError:
+            # a streamed response holds its pooled connection until it is closed
+            response.close()
+            raise
+        if self.result_format == "tsv":
+            return self.tsv_rows(response, stats)
+        stats["bytes"] = len(response.content)
+        if self.result_format == "qlever":
+            return self.qlever_rows(response)
+        return self.json_rows(response)
+
+    @staticmethod
+    def json_rows(response):
+        bindings = response.json()["results"]["bindings"]
+        for i in range(len(bindings)):
+            binding, bindings[i] = bindings[i], None
+            yield {k: v.get("value", "") for k, v in binding.items()}
+
+    @staticmethod
+    def qlever_rows(response):
+        result = response.json()
+        variables = [variable.lstrip("?") for variable in result["selected"]]
+        for row in result["res"]:
+            yield {
+                variable: decode_term(term)
+                for variable, term in zip(variables, row)
+                if term is not None
+            }
+
+    @staticmethod
+    def tsv_rows(response, stats):
+        stats["bytes"] = 0
+        with response:
+            lines = response.iter_lines()
+            header = next(lines, None)
+            if header is None:
+                return
+            stats["bytes"] += len(header) + 1
+            header = header.decode("utf-8")
+            variables = [variable.lstrip("?") for variable in header.split("\t")]
+            for line in lines:
+                stats["bytes"] += len(line) + 1
+                if not line:
+                    continue
+                yield {
+                    variable: decode_term(term)
+                    for variable, term in zip(
+                        variables, line.decode("utf-8").split("\t")
+                    )
+                    if term
+                }
@@ -0,0 +1,245 @@
+import argparse
+import heapq
+import math
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import shapely
+
+from spatial import GridIndex, haversine
+
+WALKABLE_HIGHWAYS = (
+    "footway",
+    "path",
+    "pedestrian",
+    "steps",
+    "crossing",
+    "corridor",
+    "platform",
+    "cycleway",
+    "track",
+    "living_street",
+    "residential",
+    "service",
+    "unclassified",
+    "tertiary",
+    "secondary",
+    "primary",
+)
+
+# how far a point may lie from the nearest footway node to be routed from it
+MAX_SNAP_KM = 0.3
+
+# coordinates are rounded before ways are joined at shared nodes
+COORDINATE_DECIMALS = 7
+
+
+def fetch_footways(connection, bbox):
+    min_lon, min_lat, max_lon, max_lat = bbox
+    highways = ", ".join(f'"{highway}"' for highway in WALKABLE_HIGHWAYS)
+    query = f"""
+        SELECT ?way ?geometry WHERE {{
+            ?way osmkey:highway ?highway ;
+                 geo:hasGeometry/geo:asWKT ?geometry ;
+                 geo:hasCentroid/geo:asWKT ?centroid .
+            FILTER (?highway IN ({highways}))
+            FILTER (geof:longitude(?centroid) >= {min_lon}
+                    && geof:longitude(?centroid) <= {max_lon}
+                    && geof:latitude(?centroid) >= {min_lat}
+                    && geof:latitude(?centroid) <= {max_lat})
+        }}
+    """
+
+    results = connection.query(query, kind="snapshot")
+    return results
+
+
+class WalkingGraph:
+    def __init__(self, lons, lats, indptr, neighbours, lengths, cell_size=0.01):
+        self.lons = np.asarray(lons, dtype=np.float64)
+        self.lats = np.asarray(lats, dtype=np.float64)
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.neighbours = np.asarray(neighbours, dtype=np.int32)
+        self.lengths = np.asarray(lengths, dtype=np.float32)
+        self.grid = GridIndex(self.lons, self.lats, cell_size)
+        # the search walks the adjacency node by node, which is much faster on
+        # Python lists than on array slices
+        self.adjacency = (
+            self.indptr.tolist(),
+            self.neighbours.tolist(),
+            self.lengths.tolist(),
+        )
+
+    @classmethod
+    def from_geometries(cls, geometries):
+        # ways are joined where they share a coordinate, as OSM ways share nodes
+        parts = shapely.get_parts(shapely.from_wkt(list(geometries)))
+        coordinates, index = shapely.get_coordinates(parts, return_index=True)
+        nodes, inverse = np.unique(
+            np.round(coordinates, COORDINATE_DECIMALS), axis=0, return_inverse=True
+        )
+        inverse = inverse.reshape(-1)
+
+        consecutive = index[1:] == index[:-1]
+        sources, targets = inverse[:-1][consecutive], inverse[1:][consecutive]
+        distinct = sources != targets
+        sources, targets = sources[distinct], targets[distinct]
+        lengths = haversine(
+            nodes[sources, 0], nodes[sources, 1], nodes[targets, 0], nodes[targets, 1]
+        )
+
+        sources, targets = (
+            np.concatenate([sources, targets]),
+            np.concatenate([targets, sources]),
+        )
+        lengths = np.concatenate([lengths, lengths])
+        order = np.argsort(sources, kind="stable")
+        indptr = np.zeros(len(nodes) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(sources, minlength=len(nodes)), out=indptr[1:])
+        return cls(nodes[:, 0], nodes[:, 1], indptr, targets[order], lengths[order])
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(**{name: data[name] for name in data.files})
+
+    def save(self, path):
+        np.savez_compressed(
+            path,
+            lons=self.lons,
+            lats=self.lats,
+            indptr=self.indptr,
+            neighbours=self.neighbours,
+            lengths=self.lengths,
+        )
+
+    def nearest_node(self, longitude, latitude, max_snap=MAX_SNAP_KM):
+        # returns the node and the distance to it, or (None, inf) off the graph
+        nodes, distances = self.grid.within(longitude, latitude, max_snap)
+        if not len(nodes):
+            return None, math.inf
+        return int(nodes[0]), float(distances[0])
+
+
+class WalkingSearch:
+    # Dijkstra search from one node that is continued only as far as the targets
+    # asked for so far require, so later lookups from the same origin reuse it
+    def __init__(self, graph, source, max_distance):
+        self.graph = graph
+        self.max_distance = max_distance
+        self.settled = {}
+        self.heap = [(0.0, source)]
+        self.lock = threading.Lock()
+
+    def distances(self, targets):
+        indptr, neighbours, lengths = self.graph.adjacency
+        with self.lock:
+            pending = {target for target in targets if target not in self.settled}
+            while pending and self.heap:
+                distance, node = self.heap[0]
+                if distance > self.max_distance:
+                    break
+                heapq.heappop(self.heap)
+                if node in self.settled:
+                    continue
+                self.settled[node] = distance
+                pending.discard(node)
+                for k in range(indptr[node], indptr[node + 1]):
+                    neighbour = neighbours[k]
+                    if neighbour not in self.settled:
+                        heapq.heappush(self.heap, (distance + lengths[k], neighbour))
+            return [self.settled.get(target, math.inf) for target in targets]
+
+    def size(self):
+        return len(self.settled) + len(self.heap)
+
+
+class WalkingRouter:
+    def __init__(
+        self,
+        graph,
+        max_distance=10,
+        max_snap=MAX_SNAP_KM,
+        max_origins=64,
+        max_nodes=2_000_000,
+    ):
+        self.graph = graph
+        self.max_distance = max_distance
+        self.max_snap = max_snap
+        self.max_origins = max_origins
+        self.max_nodes = max_nodes
+        self.searches = OrderedDict()
+        self.lock = threading.Lock()
+
+    def search(self, node):
+        with self.lock:
+            search = self.searches.get(node)
+            if search is None:
+                search = self.searches[node] = WalkingSearch(
+                    self.graph, node, self.max_distance
+                )
+            self.searches.move_to_end(node)
+            return search
+
+    def evict(self):
+        # searches are dropped oldest first until their settled nodes and
+        # frontiers fit in max_nodes, the search used last is always kept
+        with self.lock:
+            total = sum(search.size() for search in self.searches.values())
+            while len(self.searches) > 1 and (
+                len(self.searches) > self.max_origins or total > self.max_nodes
+            ):
+                _, search = self.searches.popitem(last=False)
+                total -= search.size()
+
+    def distances(self, longitude, latitude, lons, lats):
+        # walking distance in km from the point to each target; nan where the
+        # point or the target is not near a footway, inf where the target cannot
+        # be reached within max_distance
+        distances = np.full(len(lons), np.nan)
+        source, source_snap = self.graph.nearest_node(
+            longitude, latitude, self.max_snap
+        )
+        if source is None:
+            return distances
+
+        targets = [
+            self.graph.nearest_node(lon, lat, self.max_snap)
+            for lon, lat in zip(lons, lats)
+        ]
+        snapped = [i for i, (node, _) in enumerate(targets) if node is not None]
+        walked = self.search(source).distances([targets[i][0] for i in snapped])
+        self.evict()
+        for i, distance in zip(snapped, walked):
+            distances[i] = source_snap + distance + targets[i][1]
+        return distances
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Build the pedestrian graph of a region from OSM footways"
+    )
+    parser.add_argument("path", help="file to write the graph to (.npz)")
+    parser.add_argument(
+        "--bbox",
+        nargs=4,
+        type=float,
+        required=True,
+        metavar=("MIN_LON", "MIN_LAT", "MAX_LON", "MAX_LAT"),
+        help="only include ways inside this bounding box",
+    )
+    args = parser.parse_args()
+
+    from logic import connection
+
+    rows = fetch_footways(connection, args.bbox)
+    graph = WalkingGraph.from_geometries(row["geometry"] for row in rows)
+    graph.save(args.path)
+    print(
+        f"{len(rows)} ways, {len(graph.lons)} nodes, {len(graph.neighbours) // 2} edges"
+    )
+
+
+if __name__ == "__main__":
+    main()